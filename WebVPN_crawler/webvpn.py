@@ -1,6 +1,8 @@
 from matplotlib.pyplot import switch_backend
 from selenium.webdriver.remote.webdriver import WebDriver as wd
 from selenium.webdriver.chrome.service import Service as ChromeService
+from selenium.webdriver.chrome.options import Options as ChromeOptions
+from selenium.common.exceptions import NoSuchElementException, TimeoutException
 from webdriver_manager.chrome import ChromeDriverManager
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
@@ -8,16 +10,519 @@ from selenium.webdriver.support.ui import WebDriverWait as wdw
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.action_chains import ActionChains as AC
 import selenium
-from bs4 import BeautifulSoup as BS
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+import requests
+import argparse
+import hashlib
 import json
+import os
+import queue
+import re
+import threading
+import time
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:  # pycryptodome is only needed by the HTTP mode
+    AES = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WEBVPN_ROOT = "https://webvpn.tsinghua.edu.cn"
+DRIVER_CACHE = os.path.join(HERE, "driver.json")
+SESSION_DIR = os.path.join(HERE, "sessions")
+GRADE_CACHE = os.path.join(HERE, "grades.json")
+COOKIE_KEYS = ("name", "value", "domain", "path", "secure", "httpOnly", "expiry")
+WEBVPN_KEY = WEBVPN_IV = b"wrdvpnisthebest!"
+GRADES_URL = "zhjw.cic.tsinghua.edu.cn/cj.cjCjbAll.do?m=bks_cjdcx&cjdlx=zw"
+USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+              "Chrome/105.0.0.0 Safari/537.36")
+
+
+class SessionExpired(Exception):
+    """
+    WebVPN sent a request of the HTTP mode back to its login page
+    """
+
+
+def encode_url(url, root=WEBVPN_ROOT):
+    """
+    The WebVPN address of `url`, as the quick-access input would open it
+
+    WebVPN puts the host, encrypted with AES-128-CFB under a fixed key, in the first path segment:
+    `zhjw.cic.tsinghua.edu.cn/cj.cjCjbAll.do?m=...` becomes `<root>/http/<iv hex><host hex>/cj.cjCjbAll.do?m=...`
+
+    :param url: target URL, http:// if without a scheme
+    :param root: WebVPN to go through
+    :return: the proxied URL
+    """
+    if AES is None:
+        raise ImportError("encode_url needs pycryptodome: pip install pycryptodome")
+    parts = urlsplit(url if "://" in url else "http://" + url)
+    host = parts.hostname
+    # CFB with 128-bit segments needs whole blocks, the cipher text is cut back to the length of the host
+    padded = host + "0" * (-len(host) % 16)
+    cipher = AES.new(WEBVPN_KEY, AES.MODE_CFB, WEBVPN_IV, segment_size=128).encrypt(padded.encode())
+    scheme = parts.scheme if parts.port is None else f"{parts.scheme}-{parts.port}"
+    encoded = f"{root}/{scheme}/{WEBVPN_IV.hex()}{cipher.hex()[:len(host) * 2]}{parts.path or '/'}"
+    return encoded + (f"?{parts.query}" if parts.query else "")
+
+
+def chrome(headless=False, driver_path=None):
+    """
+    Launch Chrome
+
+    :param headless: without a window
+    :param driver_path: chromedriver to use instead of the one from `chromedriver_path`
+    :return: the driver
+    """
+    options = ChromeOptions()
+    if headless:
+        options.add_argument("--headless=new")
+        options.add_argument("--disable-gpu")
+        options.add_argument("--window-size=1280,1024")
+    return selenium.webdriver.Chrome(service=ChromeService(driver_path or chromedriver_path()), options=options)
+
+
+def chromedriver_path(cache=DRIVER_CACHE):
+    """
+    Path of the chromedriver binary, downloaded by webdriver_manager once and then pinned in `cache`
+
+    Delete the cache file to fetch a new driver, e.g. after Chrome was upgraded.
+
+    :param cache: JSON file remembering the path
+    :return: path of chromedriver
+    """
+    if os.path.exists(cache):
+        with open(cache) as f:
+            path = json.load(f)["path"]
+        if os.path.exists(path):
+            return path
+    path = ChromeDriverManager().install()
+    with open(cache, "w") as f:
+        json.dump({"path": path}, f)
+    return path
+
+
+class DriverPool:
+    """
+    At most `size` headless Chromes, lent to one account at a time and reused by the next
+
+    :param size: number of browsers
+    :param driver_path: chromedriver to use instead of the one from `chromedriver_path`
+    """
+
+    def __init__(self, size, driver_path=None):
+        self.driver_path = driver_path
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.SimpleQueue()
+        self.launched = 0
+        self.lock = threading.Lock()  # For `launched`
+
+    def acquire(self):
+        """
+        An idle browser, or a new one while fewer than `size` are lent; blocks otherwise
+
+        :return: the driver
+        """
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            with self.lock:
+                self.launched += 1
+            return chrome(True, self.driver_path)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, driver):
+        """
+        Give a browser back, logged out of everything; one that broke or was aborted is quit instead
+
+        :param driver: driver from `acquire`
+        :return:
+        """
+        try:
+            for handle in driver.window_handles[1:]:
+                driver.switch_to.window(handle)
+                driver.close()
+            driver.switch_to.window(driver.window_handles[0])
+            driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+            driver.get("about:blank")
+            self.idle.put(driver)
+        except Exception:  # Also when the browser is gone and its driver refuses connections
+            try:
+                driver.quit()
+            except Exception:
+                pass
+        finally:
+            self.slots.release()
+
+    def close(self):
+        """
+        Quit the idle browsers
+
+        :return:
+        """
+        while True:
+            try:
+                self.idle.get_nowait().quit()
+            except queue.Empty:
+                return
+
+
+class GradeTableParser(HTMLParser):
+    """
+    Cells of the grades table, `/html/body/center/table[2]`, in one pass over the page
+
+    `rows` is None until the table is found. End tags of cells and rows may be left out, as HTML allows: a cell
+    ends at the next cell or row, and a row at the next row or the end of the table. Only tags of the table
+    itself count, so a table nested in a cell does not end it.
+    """
+
+    def __init__(self, table=2):
+        super().__init__()
+        self.table = table
+        self.tables = 0  # Tables seen directly in <center>
+        self.depth = 0  # Of nested tables
+        self.centers = 0
+        self.rows = None
+        self.row = None
+        self.cell = None
+
+    def in_table(self):
+        return self.depth == 1 and self.tables == self.table and self.rows is not None
+
+    def end_cell(self):
+        if self.cell is not None:
+            self.row.append("".join("".join(self.cell).split()))
+            self.cell = None
+
+    def end_row(self):
+        self.end_cell()
+        if self.row is not None:
+            self.rows.append(self.row)
+            self.row = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "center":
+            self.centers += 1
+        elif tag == "table":
+            if self.depth == 0 and self.centers:
+                self.tables += 1
+                if self.tables == self.table:
+                    self.rows = []
+            self.depth += 1
+        elif self.in_table():
+            if tag == "tr":
+                self.end_row()
+                self.row = []
+            elif tag == "td":
+                self.end_cell()
+                if self.row is not None:
+                    self.cell = []
+
+    def handle_endtag(self, tag):
+        if tag == "center":
+            self.centers -= 1
+        elif tag == "table":
+            if self.in_table():
+                self.end_row()
+            self.depth -= 1
+        elif self.in_table():
+            if tag == "td":
+                self.end_cell()
+            elif tag == "tr":
+                self.end_row()
+
+    def handle_data(self, data):
+        if self.cell is not None:
+            self.cell.append(data)
+
+
+def parse_grades(page):
+    """
+    Courses of the grades page
+
+    :param page: HTML, bytes are decoded by their meta charset
+    :return: list of (semester, credits, grade, grade point)
+    :raises NoSuchElementException: if there is no grades table
+    :raises ValueError: if the table has no course rows
+    """
+    if isinstance(page, bytes):
+        charset = re.search(rb'charset=["\']?([\w-]+)', page[:2048])
+        page = page.decode(charset.group(1).decode() if charset else "utf8", errors="replace")
+    parser = GradeTableParser()
+    parser.feed(page)
+    parser.close()
+    if parser.rows is None:  # The login page of info instead
+        raise NoSuchElementException("no grades table")
+    courses = [(k[5], k[2], k[3], k[4]) for k in parser.rows[1:] if len(k) > 5]
+    if not courses:
+        raise ValueError(f"Grades table without courses, {len(parser.rows)} row(s)")
+    return courses
+
+
+def semester_gpa(courses):
+    """
+    Credit-weighted grade point of each semester, leaving out P/F courses
+
+    :param courses: from `parse_grades`
+    :return: dict of semester -> GPA as '%.2f', in the order of the table
+    """
+    totals = {}
+    for sem, credits, grade, point in courses:
+        if grade == 'P' or grade == 'F':
+            continue
+        total = totals.setdefault(sem, [0, 0.0])
+        total[0] += int(credits)
+        total[1] += int(credits) * float(point)
+    return {sem: '%.2f' % (score / credits) for sem, (credits, score) in totals.items()}
+
+
+def digest(courses):
+    """
+    :return: SHA-256 of the courses, as hex
+    """
+    return hashlib.sha256(json.dumps(courses, ensure_ascii=False).encode("utf8")).hexdigest()
+
+
+class GradeCache:
+    """
+    GPAs per account, kept in a JSON file and keyed by a hash of the grade table
+
+    An unchanged table returns the saved GPAs as they are; otherwise only the semesters whose rows changed are
+    aggregated again.
+
+    :param path: JSON file
+    """
+
+    def __init__(self, path=GRADE_CACHE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.recomputed = 0  # Semesters aggregated
+        self.accounts = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf8") as f:
+                self.accounts = json.load(f)
+
+    def gpa(self, username, courses):
+        """
+        :param username: account
+        :param courses: from `parse_grades`
+        :return: dict of semester -> GPA, as `semester_gpa`
+        """
+        table = digest(courses)
+        with self.lock:
+            cached = self.accounts.get(username)
+        if cached is not None and cached["hash"] == table:
+            with self.lock:
+                self.hits += 1
+            return cached["gpa"]
+
+        by_semester = {}
+        for course in courses:
+            by_semester.setdefault(course[0], []).append(course)
+        old = cached["semesters"] if cached is not None else {}
+        semesters, recomputed = {}, 0
+        for sem, rows in by_semester.items():
+            h = digest(rows)
+            if sem in old and old[sem]["hash"] == h:
+                semesters[sem] = old[sem]
+            else:
+                semesters[sem] = {"hash": h, "gpa": semester_gpa(rows).get(sem)}
+                recomputed += 1
+        gpa = {sem: s["gpa"] for sem, s in semesters.items() if s["gpa"] is not None}
+        with self.lock:
+            self.accounts[username] = {"hash": table, "gpa": gpa, "semesters": semesters}
+            self.recomputed += recomputed
+        return gpa
+
+    def save(self):
+        """
+        Write the cache, through a temporary file so a crash does not leave half of it
+
+        :return:
+        """
+        with self.lock:
+            with open(self.path + ".tmp", "w", encoding="utf8") as f:
+                json.dump(self.accounts, f, ensure_ascii=False)
+            os.replace(self.path + ".tmp", self.path)
+
 
 class WebVPN:
-    def __init__(self, opt: dict, headless=False):
+    def __init__(self, opt: dict, headless=False, driver_path=None, session_path=None, http=False, pool=None):
+        """
+        :param opt: dict with `username` and `password`
+        :param headless: run Chrome without a window
+        :param driver_path: chromedriver to use instead of the one from `chromedriver_path`
+        :param session_path: where `save_session` keeps the cookies, `sessions/<username>.json` by default
+        :param http: fetch pages with requests through `encode_url`, using Chrome only to log in
+        :param pool: `DriverPool` to borrow browsers from instead of launching them
+        """
         self.root_handle = None
         self.driver: wd = None
         self.userid = opt["username"]
         self.passwd = opt["password"]
         self.headless = headless
+        self.driver_path = driver_path
+        self.session_path = session_path or os.path.join(SESSION_DIR, f"{self.userid}.json")
+        self.restored = False  # Whether the session came from `restore_session`
+        self.http = http
+        self.session: requests.Session = None
+        self.pool = pool
+        self.aborted = False
+
+    def new_driver(self):
+        """
+        Launch Chrome, headless if `self.headless`, or borrow one from `self.pool`
+
+        :return: the driver
+        """
+        if self.aborted:
+            raise TimeoutException("aborted")
+        if self.pool is not None:
+            return self.pool.acquire()
+        return chrome(self.headless, self.driver_path)
+
+    def quit_driver(self):
+        """
+        Quit the browser, or give it back to `self.pool`
+
+        :return:
+        """
+        d, self.driver = self.driver, None
+        if d is None:
+            return
+        if self.pool is not None:
+            self.pool.release(d)
+        else:
+            d.quit()
+
+    def abort(self):
+        """
+        Make the blocked and later requests of this account fail, e.g. from a timer on another thread
+
+        :return:
+        """
+        self.aborted = True
+        for close in (self.driver and self.driver.quit, self.session and self.session.close):
+            try:
+                close and close()
+            except Exception:
+                pass
+
+    def start(self, fresh=False):
+        """
+        Get a logged-in browser fast: restore the saved session, or log in to WebVPN and info and save it
+
+        In the HTTP mode the cookies go to a requests session instead, and the browser is closed after logging in.
+
+        :param fresh: ignore the saved session
+        :return: the driver, or the requests session in the HTTP mode
+        """
+        if self.http:
+            cookies = None if fresh else self.saved_cookies()
+            self.restored = cookies is not None
+            if cookies is None:
+                self.login_webvpn()
+                self.login_info()
+                self.save_session()
+                cookies = self.driver.get_cookies()
+                self.quit_driver()
+            self.session = self.new_session(cookies)
+            return self.session
+        if not fresh and self.restore_session():
+            return self.driver
+        self.login_webvpn()
+        self.login_info()
+        self.save_session()
+        return self.driver
+
+    def new_session(self, cookies):
+        """
+        A requests session holding the WebVPN cookies, with its connections kept alive and reused
+
+        :param cookies: cookies as from `driver.get_cookies()`
+        :return: the session
+        """
+        if self.session is not None:
+            self.session.close()
+        s = requests.Session()
+        s.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        s.headers["User-Agent"] = USER_AGENT
+        for c in cookies:
+            s.cookies.set(c["name"], c["value"], domain=c.get("domain", ""), path=c.get("path", "/"))
+        return s
+
+    def fetch(self, url_input, timeout=10):
+        """
+        The HTTP mode's `access`: get the target URL through WebVPN without a browser
+
+        :param url_input: target URL
+        :param timeout: seconds
+        :return: content of the page in bytes, left for the parser to decode by its meta charset
+        """
+        r = self.session.get(encode_url(url_input), timeout=timeout)
+        r.raise_for_status()
+        if urlsplit(r.url).path.startswith("/login"):
+            raise SessionExpired(url_input)
+        return r.content
+
+    def save_session(self):
+        """
+        Save the cookies of WebVPN, which also hold the info login made through it
+
+        :return:
+        """
+        os.makedirs(os.path.dirname(self.session_path), exist_ok=True)
+        self.to_root()
+        cookies = [{k: c[k] for k in COOKIE_KEYS if k in c} for c in self.driver.get_cookies()]
+        with open(self.session_path, "w") as f:
+            json.dump({"username": self.userid, "cookies": cookies}, f)
+
+    def restore_session(self):
+        """
+        Launch a browser with the cookies from `save_session`, skipping both logins
+
+        :return: whether the saved session is still logged in
+        """
+        cookies = self.saved_cookies()
+        if cookies is None:
+            return False
+        self.quit_driver()
+        d = self.new_driver()
+        self.driver = d
+        d.get(WEBVPN_ROOT + "/login")
+        for cookie in cookies:
+            d.add_cookie(cookie)
+        d.get(WEBVPN_ROOT + "/")
+        try:
+            wdw(d, 5).until(EC.visibility_of_element_located((By.ID, "quick-access-input")))
+        except TimeoutException:  # Expired, back to the login page
+            self.quit_driver()
+            return False
+        self.root_handle = d.current_window_handle
+        self.restored = True
+        return True
+
+    def saved_cookies(self):
+        """
+        :return: the cookies from `save_session` for this account, or None
+        """
+        if not os.path.exists(self.session_path):
+            return None
+        with open(self.session_path) as f:
+            session = json.load(f)
+        if session["username"] != self.userid:
+            return None
+        return session["cookies"]
 
     def login_webvpn(self):
         """
@@ -25,11 +530,10 @@ class WebVPN:
 
         :return:
         """
-        d = self.driver
-        if d is not None:
-            d.close()
-        d = selenium.webdriver.Chrome(service=ChromeService(ChromeDriverManager().install()))
-        d.get("https://webvpn.tsinghua.edu.cn/login")
+        self.quit_driver()
+        d = self.new_driver()
+        self.driver = d
+        d.get(WEBVPN_ROOT + "/login")
         username = d.find_elements(By.XPATH,
                                    '//div[@class="login-form-item"]//input'
                                    )[0]
@@ -132,6 +636,33 @@ class WebVPN:
         #       - Before return, make sure that you have logged in successfully
         raise NotImplementedError
 
+    def grades_page(self):
+        """
+        The grades page, from a direct request in the HTTP mode or from the page opened in the browser
+
+        :return: HTML of the page
+        """
+        if self.http:
+            return self.fetch(GRADES_URL)
+        self.access(GRADES_URL)
+        self.switch_another()
+        return self.driver.page_source
+
+    def grade_rows(self):
+        """
+        Courses on the grades page, logging in again if the restored session was logged out of info
+
+        :return: list of (semester, credits, grade, grade point), see `parse_grades`
+        """
+        try:
+            return parse_grades(self.grades_page())
+        except (NoSuchElementException, SessionExpired):
+            if not self.restored or self.aborted:
+                raise
+            self.restored = False
+            self.start(fresh=True)
+            return self.grade_rows()
+
     def get_grades(self):
         """
         TODO: Get and calculate the GPA for each semester.
@@ -145,44 +676,7 @@ class WebVPN:
 
         :return:
         """
-        self.access("zhjw.cic.tsinghua.edu.cn/cj.cjCjbAll.do?m=bks_cjdcx&cjdlx=zw")
-        self.switch_another()
-        d=self.driver
-        table = d.find_element(By.XPATH,"/html/body/center/table[2]/tbody")
-        soup=BS(table.get_attribute("innerHTML"),'lxml')
-        a=soup.find_all('tr')
-        a=a[1:]
-        result={}
-        sems=[]
-        b=[]
-        for i in range(len(a)):
-          temp=a[i].find_all("td")
-          temp2=[]
-          for j in temp:
-            r=j.contents[0]
-            temp2.append(str(r).replace('\n','').replace('\t','').replace(' ',''))
-          b.append(temp2)
-        for k in b:
-          sem=str(k[5])
-          st=str(k[3])
-          if st=='P' or st== 'F':
-            continue
-          if result.__contains__(sem):
-            result[sem].append((int(k[2]),float(k[4])))
-          else:
-            result[sem]=[(int(k[2]),float(k[4]))]
-            sems.append(sem)
-        for sem in sems:
-          t=result[sem]
-          sum=0.0
-          score=0.0
-          for course in t:
-            sum+=course[0]
-            score+=course[0]*course[1]
-          score/=sum
-          score=('%.2f'%score)
-          result[sem]=score
-        return result
+        return semester_gpa(self.grade_rows())
         # Hint: - You can directly switch into
         #         `zhjw.cic.tsinghua.edu.cn/cj.cjCjbAll.do?m=bks_cjdcx&cjdlx=zw`
         #         after logged in
@@ -193,14 +687,91 @@ class WebVPN:
 
         raise NotImplementedError
 
+def account_grades(account, pool, cache, timeout, http):
+    """
+    GPAs of one account, given up after `timeout` seconds
+
+    :return: dict of semester -> GPA
+    """
+    web = WebVPN(account, headless=True, http=http, pool=pool)
+    timer = threading.Timer(timeout, web.abort)
+    timer.start()
+    try:
+        web.start()
+        rows = web.grade_rows()
+    except Exception:
+        if web.aborted:
+            raise TimeoutError(f"{account['username']}: no grades in {timeout}s")
+        raise
+    finally:
+        timer.cancel()
+        if web.session is not None:
+            web.session.close()
+        web.quit_driver()
+    return cache.gpa(account["username"], rows)
+
+
+def batch_grades(accounts, workers=4, timeout=120, http=True, cache=None, driver_path=None):
+    """
+    GPAs of many accounts, `workers` at a time on a pool of as many headless browsers
+
+    :param accounts: list of dicts with `username` and `password`
+    :param workers: accounts in flight, and browsers at most
+    :param timeout: seconds per account
+    :param http: use the HTTP mode, see `WebVPN`
+    :param cache: `GradeCache`, a new one on `GRADE_CACHE` by default
+    :param driver_path: chromedriver to use instead of the one from `chromedriver_path`
+    :return: dict of username -> GPAs or the exception, and dict of statistics
+    """
+    cache = cache or GradeCache()
+    pool = DriverPool(workers, driver_path)
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {
+            account["username"]: executor.submit(account_grades, account, pool, cache, timeout, http)
+            for account in accounts
+        }
+        results = {}
+        for username, future in futures.items():
+            try:
+                results[username] = future.result()
+            except Exception as e:
+                results[username] = e
+    pool.close()
+    cache.save()
+    elapsed = time.perf_counter() - begin
+    stats = {
+        "accounts": len(accounts),
+        "failed": sum(isinstance(r, Exception) for r in results.values()),
+        "seconds": elapsed,
+        "accounts_per_minute": len(accounts) / elapsed * 60 if elapsed else None,
+        "browsers": pool.launched,
+        "cache_hits": cache.hits,
+        "semesters_recomputed": cache.recomputed,
+    }
+    return results, stats
+
+
 if __name__ == "__main__":
-    # TODO: Write your own query process
-    with open("WebVPN_crawler\settings.json") as f:
+    parser = argparse.ArgumentParser(
+        description="GPA of each semester, for the account of settings.json or a JSON list of accounts")
+    parser.add_argument("accounts", nargs="?", default=os.path.join(HERE, "settings.json"))
+    parser.add_argument("--workers", type=int, default=4, help="accounts in flight, with a browser each")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds per account")
+    parser.add_argument("--browser", action="store_true", help="fetch pages in Chrome instead of over HTTP")
+    args = parser.parse_args()
+    with open(args.accounts) as f:
       dic = json.load(f)
       f.close()
-    web = WebVPN(dic)
-    web.login_webvpn()
-    web.login_info()
-    print(web.get_grades())
-    
-    #raise NotImplementedError
+    http = AES is not None and not args.browser
+    if isinstance(dic, dict):
+        web = WebVPN(dic, headless=True, http=http)
+        web.start()
+        print(web.get_grades())
+    else:
+        results, stats = batch_grades(dic, args.workers, args.timeout, http)
+        for username, result in results.items():
+            print(f"{username}: {result}")
+        print(f"{stats['accounts']} account(s), {stats['failed']} failed, {stats['seconds']:.1f}s, "
+              f"{stats['accounts_per_minute']:.1f} accounts/min; {stats['browsers']} browser(s), "
+              f"{stats['cache_hits']} unchanged table(s), {stats['semesters_recomputed']} semester(s) recomputed")
@@ -0,0 +1,225 @@
+"""
+Offline benchmark of the crawl pipeline: a local stub of zhihu.com and an in-memory SQLite storage
+
+The stub replays the hot list and question pages captured in test.ipynb / test2.ipynb (or given files),
+with configurable latency and error injection. Reports parse ops/s, crawl wall time, rows/s written
+and peak RSS, and can save them as JSON to compare runs.
+
+Usage:
+    python bench_crawl.py [--top 50] [--crawls 3] [--workers 8] [--rps 50] [--latency 0.05]
+                          [--error-rate 0.02] [--output result.json] [--baseline old.json]
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from zhihu import ZhihuCrawler, SETTINGS_PATH, extract_initial_data, logger
+from bench_extract import NOTEBOOK_PAGES, notebook_page
+
+TEMPLATE_QID = NOTEBOOK_PAGES[1][2][-1]  # The question of the saved question page
+BOARD_PATH = ("initialState", "topstory", "hotList")
+
+
+class StubServer:
+    """
+    A local HTTP server answering `/hot` and `/question/<qid>` with saved pages
+
+    Question pages are the saved one with its question ID replaced by the requested one.
+
+    :param board: the hot list page
+    :param question: a question page of `TEMPLATE_QID`
+    :param latency: seconds to wait before answering
+    :param jitter: extra random wait, up to this many seconds
+    :param error_rate: probability of answering 503 instead
+    """
+
+    def __init__(self, board: bytes, question: bytes, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        rng = random.Random(seed)
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, as zhihu.com
+
+            def do_GET(self):
+                time.sleep(latency + rng.uniform(0, jitter))
+                with stub.lock:
+                    stub.requests += 1
+                    failed = rng.random() < error_rate
+                    stub.errors += failed
+                if failed:
+                    body, status = b"Service Unavailable", 503
+                elif self.path == "/hot":
+                    body, status = board, 200
+                elif self.path.startswith("/question/"):
+                    body, status = question.replace(TEMPLATE_QID.encode(), self.path.rsplit("/", 1)[1].encode()), 200
+                else:
+                    body, status = b"Not Found", 404
+                self.send_response(status)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def close(self):
+        self.server.shutdown()
+
+
+class OfflineCrawler(ZhihuCrawler):
+    """
+    A ZhihuCrawler on the SQLite storage, timing how long writing the crawls takes
+
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.rows_written = 0
+        self.write_seconds = 0.0
+
+    def write_crawl(self, crawl_id, end_time, rows, revisions=()):
+        begin = time.perf_counter()
+        super().write_crawl(crawl_id, end_time, rows, revisions)
+        self.write_seconds += time.perf_counter() - begin
+        self.rows_written += len(rows)
+
+    def failed_details(self, crawl_id):
+        return self.storage.query(
+            "SELECT COUNT(*) AS n FROM record WHERE crawl_id = %s AND created IS NULL", crawl_id,
+            lambda cur: cur.fetchone()["n"]
+        )
+
+
+def ops_per_second(fn, seconds=1.0):
+    count, begin = 0, time.perf_counter()
+    while time.perf_counter() - begin < seconds:
+        fn()
+        count += 1
+    return count / (time.perf_counter() - begin)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--board", help="saved hot list page, instead of the one in test.ipynb")
+    parser.add_argument("--question", help=f"saved page of question {TEMPLATE_QID}, instead of the one in test2.ipynb")
+    parser.add_argument("--top", type=int, default=50, help="entries per crawl, as watch(top=N)")
+    parser.add_argument("--crawls", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rps", type=float, default=50, help="requests per second of the rate limiter")
+    parser.add_argument("--interval", type=float, default=0, help="interval_between_question when --workers 1")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--cache", action="store_true", help="keep the detail cache on between crawls")
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare with")
+    parser.add_argument("-v", "--verbose", action="store_true", help="keep the crawler's INFO logs")
+    args = parser.parse_args()
+    if not args.verbose:
+        logger.setLevel("WARNING")
+
+    board = open(args.board, "rb").read() if args.board else notebook_page(*NOTEBOOK_PAGES[0][:2])
+    question = open(args.question, "rb").read() if args.question else notebook_page(*NOTEBOOK_PAGES[1][:2])
+    question_path = ("initialState", "entities", "questions", TEMPLATE_QID)
+    results = {
+        "time": time.time(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "verbose")},
+        "parse_ops_per_sec": {
+            "board": ops_per_second(lambda: extract_initial_data(board, BOARD_PATH)),
+            "question": ops_per_second(lambda: extract_initial_data(question, question_path)),
+        },
+    }
+
+    stub = StubServer(board, question, args.latency, args.jitter, args.error_rate)
+    with open(SETTINGS_PATH, "r", encoding="utf8") as f:
+        settings = copy.deepcopy(json.load(f))
+    settings["config"].update({
+        "base_url": stub.url,
+        "workers": args.workers,
+        "requests_per_second": args.rps,
+        "burst": max(args.workers, 1),
+        "interval_between_question": args.interval,
+        "detail_cache_size": settings["config"].get("detail_cache_size", 2000) if args.cache else 0,
+        "spool_dir": "",
+        "search_index_path": "",
+        "storage": "sqlite",
+        "sqlite_path": ":memory:",
+    })
+    crawler = OfflineCrawler(settings)
+    crawler.create_table()
+
+    crawls = []
+    for _ in range(args.crawls):
+        begin = time.perf_counter()
+        crawl_id = crawler.crawl_once(top=args.top)
+        crawls.append({"wall_seconds": time.perf_counter() - begin, "failed_details": crawler.failed_details(crawl_id)})
+    stub.close()
+
+    results.update({
+        "crawls": crawls,
+        "crawl_wall_seconds": statistics.median(c["wall_seconds"] for c in crawls),
+        "rows_per_sec": crawler.rows_written / crawler.write_seconds if crawler.write_seconds else None,
+        "peak_rss_mb": peak_rss_mb(),
+        "stub": {"requests": stub.requests, "errors": stub.errors},
+    })
+
+    print(f"parse ops/s      board {results['parse_ops_per_sec']['board']:.0f}, "
+          f"question {results['parse_ops_per_sec']['question']:.0f}")
+    print(f"crawl wall time  {results['crawl_wall_seconds']:.2f}s (median of {len(crawls)}, top {args.top}), "
+          f"{sum(c['failed_details'] for c in crawls)} failed detail(s)")
+    print(f"rows/s written   {results['rows_per_sec'] or 0:.0f}")
+    print(f"peak RSS         {results['peak_rss_mb'] or 0:.1f} MB")
+    print(f"stub             {stub.requests} request(s), {stub.errors} injected error(s)")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf8") as f:
+            baseline = json.load(f)
+        print("vs baseline:")
+        for name, new, old in (
+                ("crawl_wall_seconds", results["crawl_wall_seconds"], baseline["crawl_wall_seconds"]),
+                ("rows_per_sec", results["rows_per_sec"], baseline["rows_per_sec"]),
+                ("parse board", results["parse_ops_per_sec"]["board"], baseline["parse_ops_per_sec"]["board"]),
+                ("parse question", results["parse_ops_per_sec"]["question"], baseline["parse_ops_per_sec"]["question"]),
+                ("peak_rss_mb", results["peak_rss_mb"], baseline["peak_rss_mb"]),
+        ):
+            if new and old:
+                print(f"  {name:<20}{old:>12.2f} -> {new:>12.2f} ({new / old - 1:+.0%})")
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
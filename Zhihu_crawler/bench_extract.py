@@ -0,0 +1,109 @@
+"""
+Micro-benchmark of js-initialData extraction: BeautifulSoup vs byte scanning
+
+Usage:
+    python bench_extract.py [page.html ...] [-n 50]
+
+Without pages, the hot list and question pages captured in test.ipynb / test2.ipynb are used.
+"""
+import argparse
+import ast
+import json
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup as BS
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from zhihu import extract_initial_data
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+NOTEBOOK_PAGES = [
+    # (notebook, cell holding the page as output, path of the value the crawler needs)
+    ("test.ipynb", 7, ("initialState", "topstory", "hotList")),
+    ("test2.ipynb", 3, ("initialState", "entities", "questions", "543383284")),
+]
+
+
+def bs_extract(page: bytes, path):
+    """
+    The original path: build the DOM, find the script, decode everything, then index into it
+
+    """
+    script = BS(page, "lxml").find("script", id="js-initialData", type="text/json")
+    data = json.loads(script.text)
+    for key in path:
+        data = data[key]
+    return data
+
+
+def guess_path(page: bytes):
+    """
+    The value the crawler reads from a page: the hot list, or the question entity
+
+    """
+    data = extract_initial_data(page)["initialState"]
+    if data.get("topstory", {}).get("hotList"):
+        return "initialState", "topstory", "hotList"
+    qid = next(iter(data["entities"]["questions"]))
+    return "initialState", "entities", "questions", qid
+
+
+def notebook_page(notebook: str, cell: int) -> bytes:
+    """
+    A page saved as the output of a notebook cell
+
+    """
+    with open(os.path.join(HERE, notebook), encoding="utf8") as f:
+        output = json.load(f)["cells"][cell]["outputs"][0]["data"]["text/plain"]
+    return ast.literal_eval("".join(output)).encode("utf8")
+
+
+def load_pages(paths):
+    """
+    :return: list of (name, page bytes, path)
+    """
+    pages = []
+    for path in paths:
+        with open(path, "rb") as f:
+            page = f.read()
+        pages.append((os.path.basename(path), page, guess_path(page)))
+    if not paths:
+        for notebook, cell, path in NOTEBOOK_PAGES:
+            pages.append((notebook, notebook_page(notebook, cell), path))
+    return pages
+
+
+def timeit(fn, n):
+    begin = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - begin) / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pages", nargs="*", help="saved HTML pages")
+    parser.add_argument("-n", type=int, default=50, help="iterations per method")
+    args = parser.parse_args()
+
+    print(f"{'page':<24}{'KB':>8}{'bs4 ms':>10}{'full ms':>10}{'subtree ms':>12}{'speedup':>10}")
+    for name, page, path in load_pages(args.pages):
+        expected = bs_extract(page, path)
+        assert extract_initial_data(page, path) == expected, f"{name}: extracted value differs"
+
+        def full():
+            data = extract_initial_data(page)
+            for key in path:
+                data = data[key]
+
+        bs = timeit(lambda: bs_extract(page, path), args.n)
+        fast = timeit(full, args.n)
+        subtree = timeit(lambda: extract_initial_data(page, path), args.n)
+        print(f"{name:<24}{len(page) / 1024:>8.0f}{bs * 1000:>10.2f}{fast * 1000:>10.2f}"
+              f"{subtree * 1000:>12.2f}{bs / min(fast, subtree):>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Benchmark the README analytics query shapes on a generated `record` table, without and with the indexes
+
+Usage:
+    python bench_queries.py [--rows 2000000] [--database zhihu_bench] [--output result.json]
+
+The database given by --database is dropped and recreated on the MySQL server of zhihu.json,
+so it must not be the crawler's database.
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import pymysql
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from zhihu import ZhihuCrawler, SETTINGS_PATH, logger
+
+PARSED_HEAT = "CAST(SUBSTRING_INDEX(REPLACE(heat, ' ', ''), '万', 1) AS UNSIGNED)"
+
+# name -> (query without heat_w and indexes, query with them)
+QUERIES = {
+    "Q4 trend of a question": (
+        "SELECT heat, hit_at, visitCount, followerCount FROM record WHERE qid = %s ORDER BY hit_at",
+        "SELECT heat_w, hit_at, visitCount, followerCount FROM record WHERE qid = %s ORDER BY hit_at",
+    ),
+    "Q5 appearances per title": (
+        "SELECT title, COUNT(*) cnt FROM record GROUP BY title HAVING cnt > 100 ORDER BY cnt DESC",
+        "SELECT title, COUNT(*) cnt FROM record GROUP BY title HAVING cnt > 100 ORDER BY cnt DESC",
+    ),
+    "Q6 most visited record": (
+        "SELECT title, visitCount, hit_at, heat, ranking FROM record "
+        "WHERE visitCount = (SELECT MAX(visitCount) FROM record)",
+        "SELECT title, visitCount, hit_at, heat, ranking FROM record "
+        "WHERE visitCount = (SELECT MAX(visitCount) FROM record)",
+    ),
+    "Top 10 by heat": (
+        f"SELECT qid, title, heat FROM record ORDER BY {PARSED_HEAT} DESC LIMIT 10",
+        "SELECT qid, title, heat FROM record ORDER BY heat_w DESC LIMIT 10",
+    ),
+}
+
+
+def generate(rows: int, per_crawl: int = 50, seed: int = 0):
+    """
+    Yield (crawl rows, record rows) of synthetic crawls every 10 minutes
+
+    Question popularity is heavy-tailed, so some questions stay on the board for hundreds of crawls.
+    """
+    rng = random.Random(seed)
+    questions = max(rows // 100, per_crawl)
+    begin = 1657238400.0
+    visits = {}
+    for crawl_id in range(1, rows // per_crawl + 1):
+        at = begin + crawl_id * 600
+        qids = set()
+        while len(qids) < per_crawl:
+            qids.add(500000000 + min(int(rng.paretovariate(1.2)), questions))
+        records = []
+        for ranking, qid in enumerate(sorted(qids, key=lambda _: rng.random())):
+            heat = rng.randint(10, 5000)
+            visits[qid] = visits.get(qid, rng.randint(1000, 100000)) + rng.randint(0, 50000)
+            records.append({
+                "qid": qid, "crawl_id": crawl_id, "title": f"问题 {qid}：高考之后应该做些什么？",
+                "heat": f"{heat} 万热度", "heat_w": heat, "created": int(begin) - qid % 86400,
+                "visitCount": visits[qid], "followerCount": visits[qid] // 100, "answerCount": visits[qid] // 1000,
+                "excerpt": None, "raw": None, "ranking": ranking, "hit_at": at + ranking * 0.1,
+                "url": f"https://www.zhihu.com/question/{qid}",
+            })
+        yield (crawl_id, at, at + 60), records
+
+
+def run(crawler, sql, args, repeat):
+    """
+    :return: median seconds of `repeat` runs
+    """
+    times = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        crawler.storage.query(sql, args if "%s" in sql else None, lambda cur: cur.fetchall())
+        times.append(time.perf_counter() - begin)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--database", default="zhihu_bench")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="save the results as JSON")
+    args = parser.parse_args()
+
+    with open(SETTINGS_PATH, "r", encoding="utf8") as f:
+        settings = json.load(f)
+    if args.database == settings["mysql"].get("database"):
+        parser.error("refusing to drop the crawler's database")
+    server = {k: v for k, v in settings["mysql"].items() if k != "database"}
+    with pymysql.connect(**server) as conn, conn.cursor() as cur:
+        cur.execute(f"DROP DATABASE IF EXISTS `{args.database}`")
+        cur.execute(f"CREATE DATABASE `{args.database}`")
+
+    settings = copy.deepcopy(settings)
+    settings["mysql"]["database"] = args.database
+    settings["config"]["dedup_content"] = False
+    crawler = ZhihuCrawler(settings)
+    crawler.create_table()
+    storage = crawler.storage
+    storage.query("ALTER TABLE record " + ", ".join(f"DROP INDEX `{name}`" for name in storage.RECORD_INDEXES) + ";")
+
+    logger.info(f"Generating {args.rows} records")
+    crawls = []
+
+    def records():
+        for crawl, rows in generate(args.rows):
+            crawls.append(crawl)
+            yield from rows
+
+    crawler.backfill(records())
+    with storage.transaction() as cur:
+        cur.executemany("INSERT INTO crawl (id, begin, end) VALUES (%s, %s, %s)", crawls)
+    popular = storage.query(
+        "SELECT qid FROM record GROUP BY qid ORDER BY COUNT(*) DESC LIMIT 1;", op=lambda cur: cur.fetchone()["qid"])
+    params = (popular,)
+
+    results = {"rows": args.rows, "queries": {}}
+    for phase in ("before", "after"):
+        if phase == "after":
+            begin = time.perf_counter()
+            storage.migrate()
+            results["index_build_seconds"] = time.perf_counter() - begin
+        storage.query("ANALYZE TABLE record;", op=lambda cur: cur.fetchall())
+        for name, queries in QUERIES.items():
+            sql = queries[0] if phase == "before" else queries[1]
+            results["queries"].setdefault(name, {})[phase] = run(crawler, sql, params, args.repeat)
+
+    print(f"{'query':<28}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name, timing in results["queries"].items():
+        print(f"{name:<28}{timing['before'] * 1000:>12.1f}{timing['after'] * 1000:>12.1f}"
+              f"{timing['before'] / timing['after']:>9.0f}x")
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Benchmark keyword search: the bigram search index vs `LIKE '%term%'` over title, excerpt and raw
+
+Usage:
+    python bench_search.py [--rows 100000] [--storage sqlite|mysql] [--output result.json]
+
+Synthetic crawls of Chinese questions are written to a fresh storage (see bench_storage.py for where),
+the search index is rebuilt from it, and each query is run both ways; their results must agree.
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from zhihu import ZhihuCrawler, SearchIndex, SETTINGS_PATH, RECORD_COLUMNS, logger
+from bench_storage import open_storage
+
+WORDS = (
+    "高考 志愿 大学 清华 北大 专业 就业 考研 留学 人工智能 机器学习 编程 数学 物理 历史 电影 音乐 旅行 美食 健身 "
+    "减肥 恋爱 婚姻 父母 孩子 教育 房价 工作 面试 薪资 创业 投资 股票 基金 手机 电脑 游戏 动漫 小说 宠物 天气 城市 "
+    "北京 上海 深圳 杭州 成都 医院 医生 科技 芯片 汽车 新能源 体育 足球 篮球 奥运 如何 评价 为什么 怎样 看待"
+).split()
+QUERIES = ["高考", "清华大学", "机器学习", "新能源汽车", "芯片 OR 奥运", '"如何评价"', "减肥健身"]
+
+
+def generate(rows: int, per_crawl: int = 50, seed: int = 0):
+    """
+    Yield (crawl, record rows) of synthetic crawls every 10 minutes, with texts made of `WORDS`
+
+    """
+    rng = random.Random(seed)
+    questions = {}
+
+    def text(low, high):
+        return "".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+    begin = 1657238400.0
+    for crawl_id in range(1, rows // per_crawl + 1):
+        at = begin + crawl_id * 600
+        qids = set()
+        while len(qids) < per_crawl:
+            qids.add(500000000 + min(int(rng.paretovariate(1.2)), max(rows // 100, per_crawl)))
+        records = []
+        for ranking, qid in enumerate(sorted(qids)):
+            if qid not in questions or rng.random() < 0.01:  # A few questions get retitled or rewritten
+                questions[qid] = (text(3, 6) + "？", text(15, 30), text(60, 150))
+            title, excerpt, raw = questions[qid]
+            records.append(dict(
+                dict.fromkeys(RECORD_COLUMNS), qid=qid, crawl_id=crawl_id, title=title, heat="100 万热度",
+                heat_w=100, excerpt=excerpt, raw=raw, ranking=ranking, hit_at=at,
+            ))
+        yield {"id": crawl_id, "begin": at, "end": at + 60}, records
+
+
+def like_search(storage, query):
+    """
+    The same query with LIKE: each term must be in one of the texts of some record of the question
+
+    """
+    alternatives, args = [], []
+    for terms in SearchIndex().parse(query):
+        per_term = []
+        for term in terms:
+            per_term.append(
+                "qid IN (SELECT qid FROM record WHERE title LIKE %s OR excerpt LIKE %s OR raw LIKE %s)")
+            args += [f"%{term}%"] * 3
+        alternatives.append("(" + " AND ".join(per_term) + ")")
+    sql = f"SELECT DISTINCT qid FROM record WHERE {' OR '.join(alternatives)};"
+    return {row["qid"] for row in storage.query(sql, args, lambda cur: cur.fetchall())}
+
+
+def timeit(fn, repeat):
+    times, result = [], None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - begin)
+    return statistics.median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--storage", choices=["sqlite", "mysql"], default="sqlite")
+    parser.add_argument("--database", default="zhihu_bench")
+    parser.add_argument("--sqlite-path", default="zhihu_bench.db")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="save the results as JSON")
+    args = parser.parse_args()
+
+    with open(SETTINGS_PATH, "r", encoding="utf8") as f:
+        settings = json.load(f)
+    if args.storage == "mysql" and args.database == settings["mysql"].get("database"):
+        parser.error("refusing to drop the crawler's database")
+    settings = copy.deepcopy(settings)
+    settings["config"].update({"storage": "sqlite", "sqlite_path": ":memory:", "search_index_path": "", "spool_dir": ""})
+    crawler = ZhihuCrawler(settings)
+    crawler.storage = open_storage(args.storage, args, settings)
+
+    logger.info(f"Writing {args.rows} records")
+    crawls = list(generate(args.rows))
+    for i in range(0, len(crawls), 100):
+        crawler.storage.write_crawls(crawls[i:i + 100])
+
+    begin = time.perf_counter()
+    crawler.reindex()
+    results = {
+        "rows": args.rows, "storage": args.storage, "index_build_seconds": time.perf_counter() - begin,
+        "questions": len(crawler.index.documents), "grams": len(crawler.index.postings), "queries": {},
+    }
+
+    print(f"index built in {results['index_build_seconds']:.1f}s: "
+          f"{results['questions']} question(s), {results['grams']} gram(s)")
+    print(f"{'query':<20}{'matches':>10}{'LIKE ms':>12}{'index ms':>12}{'speedup':>10}")
+    for query in QUERIES:
+        like_seconds, expected = timeit(lambda: like_search(crawler.storage, query), args.repeat)
+        index_seconds, found = timeit(lambda: crawler.search(query, limit=None), args.repeat)
+        assert {qid for qid, _ in found} == expected, f"{query}: results differ"
+        results["queries"][query] = {"matches": len(expected), "like": like_seconds, "index": index_seconds}
+        print(f"{query:<20}{len(expected):>10}{like_seconds * 1000:>12.1f}{index_seconds * 1000:>12.3f}"
+              f"{like_seconds / index_seconds:>9.0f}x")
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
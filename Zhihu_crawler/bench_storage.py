@@ -0,0 +1,117 @@
+"""
+Compare the storages: ingest throughput of `write_crawls` and latency of the analytics queries
+
+Usage:
+    python bench_storage.py [--rows 200000] [--storages sqlite mysql] [--group 1] [--output result.json]
+
+Crawls are written one per transaction, as `watch` does, or --group per transaction, as the spool drainer does.
+The MySQL storage writes to the database given by --database, which is dropped and recreated on the MySQL
+server of zhihu.json, so it must not be the crawler's database. The SQLite file given by --sqlite-path is
+deleted first.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import pymysql
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from zhihu import MySQLStorage, SQLiteStorage, SETTINGS_PATH, RECORD_COLUMNS, logger
+from bench_queries import QUERIES, generate
+
+
+def open_storage(name, args, settings):
+    """
+    A fresh, empty storage with its tables created
+
+    """
+    config = dict(settings["config"], dedup_content=False)
+    if name == "sqlite":
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.sqlite_path + suffix):
+                os.remove(args.sqlite_path + suffix)
+        storage = SQLiteStorage(args.sqlite_path, config)
+    else:
+        server = {k: v for k, v in settings["mysql"].items() if k != "database"}
+        with pymysql.connect(**server) as conn, conn.cursor() as cur:
+            cur.execute(f"DROP DATABASE IF EXISTS `{args.database}`")
+            cur.execute(f"CREATE DATABASE `{args.database}`")
+        storage = MySQLStorage(dict(server, database=args.database), config)
+    storage.create_table()
+    return storage
+
+
+def ingest(storage, crawls, group):
+    """
+    :return: rows written per second
+    """
+    rows = sum(len(records) for _, records in crawls)
+    begin = time.perf_counter()
+    for i in range(0, len(crawls), group):
+        storage.write_crawls([
+            ({"id": crawl_id, "begin": crawl_begin, "end": crawl_end}, records)
+            for (crawl_id, crawl_begin, crawl_end), records in crawls[i:i + group]
+        ])
+    return rows / (time.perf_counter() - begin)
+
+
+def run(storage, sql, args, repeat):
+    """
+    :return: median seconds of `repeat` runs
+    """
+    times = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        storage.query(sql, args if "%s" in sql else None, lambda cur: cur.fetchall())
+        times.append(time.perf_counter() - begin)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--storages", nargs="+", choices=["sqlite", "mysql"], default=["sqlite", "mysql"])
+    parser.add_argument("--group", type=int, default=1, help="crawls per transaction")
+    parser.add_argument("--database", default="zhihu_bench")
+    parser.add_argument("--sqlite-path", default="zhihu_bench.db")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="save the results as JSON")
+    args = parser.parse_args()
+
+    with open(SETTINGS_PATH, "r", encoding="utf8") as f:
+        settings = json.load(f)
+    if "mysql" in args.storages and args.database == settings["mysql"].get("database"):
+        parser.error("refusing to drop the crawler's database")
+
+    logger.info(f"Generating {args.rows} records")
+    crawls = [
+        (crawl, [dict(dict.fromkeys(RECORD_COLUMNS), **record) for record in records])
+        for crawl, records in generate(args.rows)
+    ]
+
+    results = {"rows": args.rows, "group": args.group, "storages": {}}
+    for name in args.storages:
+        storage = open_storage(name, args, settings)
+        result = results["storages"][name] = {"ingest_rows_per_sec": ingest(storage, crawls, args.group), "queries": {}}
+        storage.query("ANALYZE;" if name == "sqlite" else "ANALYZE TABLE record;", op=lambda cur: cur.fetchall())
+        popular = storage.query(
+            "SELECT qid FROM record GROUP BY qid ORDER BY COUNT(*) DESC LIMIT 1;", op=lambda cur: cur.fetchone()["qid"])
+        for query, (_, sql) in QUERIES.items():
+            result["queries"][query] = run(storage, sql, (popular,), args.repeat)
+        storage.close()
+
+    names = list(results["storages"])
+    print(f"{'':<28}" + "".join(f"{name:>14}" for name in names))
+    print(f"{'ingest rows/s':<28}" + "".join(f"{results['storages'][name]['ingest_rows_per_sec']:>14.0f}" for name in names))
+    for query in QUERIES:
+        print(f"{query + ' ms':<28}" + "".join(f"{results['storages'][name]['queries'][query] * 1000:>14.1f}" for name in names))
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
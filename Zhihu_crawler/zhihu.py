@@ -2,8 +2,43 @@
 import json
 import pymysql
 from bs4 import BeautifulSoup as BS
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
 import logging
 import time
+import os
+import re
+import zlib
+import struct
+import hashlib
+import argparse
+import threading
+import socket
+import sqlite3
+import queue
+import atexit
+import cProfile
+import functools
+import math
+import uuid
+import pickle
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from itertools import accumulate, groupby
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging.handlers import QueueHandler, QueueListener
+
+try:
+    import numpy as np
+except ImportError:  # The recent window falls back to plain Python
+    np = None
 
 fmt = '%(asctime)s.%(msecs)03d [%(levelname)s] %(message)s'
 datefmt = '%Y-%m-%d %H:%M:%S'
@@ -16,12 +51,291 @@ logger.setLevel(level)
 file = logging.FileHandler("../zhihu.log", encoding='utf-8')
 file.setLevel(level)
 file.setFormatter(formatter)
-logger.addHandler(file)
 
 console = logging.StreamHandler()
 console.setLevel(level)
 console.setFormatter(formatter)
-logger.addHandler(console)
+
+# The handlers run on a listener thread, so disk and console I/O never block the crawl
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, file, console, respect_handler_level=True)
+logger.addHandler(QueueHandler(log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+class Metrics:
+    """
+    Thread-safe counters, histograms and gauges, rendered in the Prometheus text format
+
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600)
+    HELP = {
+        "zhihu_stage_seconds": ("histogram", "Time spent in each stage of the crawl"),
+        "zhihu_http_phase_seconds": ("histogram", "Time spent in each phase of HTTP requests"),
+        "zhihu_errors_total": ("counter", "Exceptions raised by each stage"),
+        "zhihu_http_responses_total": ("counter", "HTTP responses by status code"),
+        "zhihu_http_retries_total": ("counter", "HTTP requests retried"),
+        "zhihu_http_bytes_total": ("counter", "Bytes downloaded"),
+        "zhihu_skipped_ticks_total": ("counter", "Scheduled crawls skipped because the previous crawl overran"),
+        "zhihu_details_deferred_total": ("counter", "Question details not fetched before the crawl deadline"),
+        "zhihu_title_revisions_total": ("counter", "Questions seen with a new title"),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+        self.gauges = {}  # name -> (help, function returning {labels: value})
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def gauge(self, name, help_text, fn):
+        """
+        Register a gauge read when rendering
+
+        :param fn: returns a dict of label dict items (tuple of pairs) -> value
+        """
+        self.gauges[name] = (help_text, fn)
+
+    def render(self) -> str:
+        def labels(pairs, extra=()):
+            pairs = tuple(pairs) + tuple(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+        lines, described = [], set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                kind, text = self.HELP.get(name, ("untyped", name))
+                lines.extend([f"# HELP {name} {text}", f"# TYPE {name} {kind}"])
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, list(v)) for k, v in self.histograms.items())
+        for (name, pairs), value in counters:
+            describe(name)
+            lines.append(f"{name}{labels(pairs)} {value}")
+        for (name, pairs), histogram in histograms:
+            describe(name)
+            for bound, count in zip(self.BUCKETS, histogram):
+                lines.append(f"{name}_bucket{labels(pairs, (('le', bound),))} {count}")
+            lines.append(f"{name}_bucket{labels(pairs, (('le', '+Inf'),))} {histogram[-1]}")
+            lines.append(f"{name}_sum{labels(pairs)} {histogram[-2]}")
+            lines.append(f"{name}_count{labels(pairs)} {histogram[-1]}")
+        for name, (help_text, fn) in sorted(self.gauges.items()):
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge"])
+            for pairs, value in fn().items():
+                lines.append(f"{name}{labels(pairs)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """
+        Serve `/metrics` on a background thread
+
+        :return: the server
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Metrics served at http://{host}:{port}/metrics")
+        return server
+
+
+metrics = Metrics()
+
+
+def timed(stage):
+    """
+    Record the duration of a function in `zhihu_stage_seconds` and its exceptions in `zhihu_errors_total`
+
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            begin = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                metrics.inc("zhihu_errors_total", stage=stage)
+                raise
+            finally:
+                metrics.observe("zhihu_stage_seconds", time.perf_counter() - begin, stage=stage)
+        return wrapper
+    return decorator
+
+RECORD_COLUMNS = (
+    "qid", "crawl_id", "title", "heat", "heat_w", "created", "visitCount", "followerCount", "answerCount",
+    "excerpt", "raw", "excerpt_hash", "raw_hash", "ranking", "hit_at", "url"
+)
+ROLLUP_METRICS = ("heat_w", "visitCount", "followerCount", "answerCount", "ranking")
+ROLLUP_TABLES = {"record_hourly": 3600, "record_daily": 86400}  # Rollup table -> bucket width in seconds
+CONTENT_COLUMNS = ("excerpt", "raw")  # LONGTEXT columns stored once in `content`, keyed by hash
+# Fill `title_revision` from the history in `record`: the first title of each question, then every change.
+# For SQLite; `MySQLStorage.backfill_revisions` does the same without the window function, which needs MySQL 8.0
+BACKFILL_REVISIONS_SQL = """
+INSERT INTO title_revision (qid, crawl_id, at, old_title, title)
+SELECT qid, crawl_id, at, old_title, title FROM (
+    SELECT r.qid, r.crawl_id, c.begin AS at, r.title,
+           LAG(r.title) OVER (PARTITION BY r.qid ORDER BY r.crawl_id, r.id) AS old_title
+    FROM record r JOIN crawl c ON c.id = r.crawl_id
+) t
+WHERE old_title IS NULL OR old_title <> title;
+"""
+INSERT_REVISION_SQL = "INSERT INTO title_revision (qid, crawl_id, at, old_title, title) " \
+                      "VALUES (%(qid)s, %(crawl_id)s, %(at)s, %(old_title)s, %(title)s)"
+WINDOW_METRICS = ("heat_w", "visitCount", "answerCount", "followerCount")  # Kept in memory by `RecentWindow`
+EXPORT_INTEGERS = {"id", "qid", "crawl_id", "heat_w", "created", "visitCount", "followerCount", "answerCount", "ranking"}
+EXPORT_FLOATS = {"begin", "end", "hit_at", "crawl_begin"}
+
+
+def compress_content(text: str) -> bytes:
+    """
+    Compress text in the format of MySQL `COMPRESS()`, so `UNCOMPRESS()` can read it back in SQL
+
+    """
+    data = text.encode("utf8")
+    if not data:
+        return b""
+    return struct.pack("<I", len(data)) + zlib.compress(data)
+
+
+def decompress_content(body: bytes) -> str:
+    """
+    Inverse of `compress_content`
+
+    """
+    if not body:
+        return ""
+    return zlib.decompress(body[4:]).decode("utf8")
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf8")).hexdigest()
+
+
+INITIAL_DATA_MARKER = b'id="js-initialData"'
+_JSON_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"')
+_NOT_BRACKET = re.compile(rb'[^{}\[\]]+')
+_BRACKET_DELTA = [0] * 256
+_BRACKET_DELTA[ord("{")] = _BRACKET_DELTA[ord("[")] = 1
+_BRACKET_DELTA[ord("}")] = _BRACKET_DELTA[ord("]")] = -1
+
+
+def _locate(payload: bytes, path) -> int:
+    """
+    Find where the value at `path` starts in a JSON document, without decoding it
+
+    Each key must sit directly inside the value of the previous one, checked by counting brackets outside strings.
+
+    :param payload: the JSON document
+    :param path: keys from the root to the value
+    :return: offset of the value
+    """
+    pos = 0
+    for key in path:
+        needle = json.dumps(key).encode() + b":"
+        found = payload.find(needle, pos)
+        if found < 0:
+            raise ValueError(f"Key {key} not found")
+        brackets = _NOT_BRACKET.sub(b"", _JSON_STRING.sub(b"", payload[pos:found]))
+        depths = list(accumulate(map(_BRACKET_DELTA.__getitem__, brackets)))
+        if not depths or min(depths) < 1 or depths[-1] != 1:
+            raise ValueError(f"Key {key} is not a direct child of its parent")
+        pos = found + len(needle)
+    return pos
+
+
+def extract_initial_data(page, path=()):
+    """
+    Decode the JSON in `<script id="js-initialData">` of a Zhihu page without building a DOM
+
+    The script is located by scanning the raw bytes. With `path`, only the value at that path is decoded.
+    If the markup is not as expected, the page is parsed with BeautifulSoup instead.
+
+    :param page: the page as bytes or str
+    :param path: keys from the root of the JSON to the value needed, e.g. ("initialState", "topstory", "hotList")
+    :return: the decoded value
+    """
+    if isinstance(page, str):
+        page = page.encode("utf8")
+    payload = None
+    try:
+        start = page.find(INITIAL_DATA_MARKER)
+        if start < 0:
+            raise ValueError("js-initialData not found")
+        start = page.index(b">", start) + 1
+        payload = page[start:page.index(b"</script>", start)]
+        if not path:
+            return json.loads(payload)
+        offset = _locate(payload, path)
+        return json.JSONDecoder().raw_decode(payload[offset:].decode("utf8").lstrip())[0]
+    except ValueError as e:
+        logger.warning(f"Fast js-initialData extraction failed: {e}. Fall back to the full parser")
+
+    if payload is None:
+        script = BS(page, "lxml").find("script", id="js-initialData")
+        if script is None:
+            raise ValueError("js-initialData not found in page")
+        payload = script.text
+    data = json.loads(payload)
+    for key in path:
+        data = data[key]
+    return data
+
+
+HEAT_PATTERN = re.compile(r"([\d.]+)\s*(万|亿)?")
+
+
+def parse_heat(heat):
+    """
+    Parse a heat text such as '76万热度' or '1802 万热度' into an integer in units of 万
+
+    :return: the heat, or None if it cannot be parsed
+    """
+    match = HEAT_PATTERN.search(heat or "")
+    if match is None:
+        return None
+    value = float(match.group(1))
+    if match.group(2) == "亿":
+        value *= 10000
+    elif match.group(2) is None:
+        value /= 10000
+    return int(value + 0.5)  # Halves up, as MySQL `ROUND` in `MySQLStorage.backfill_heat`
+
 
 def getQid(url):
   temp=url[0:31]
@@ -29,213 +343,2680 @@ def getQid(url):
     return int(url[31:])
   else:
     return 0
-class ZhihuCrawler:
-    def __init__(self):
-        with open("Zhihu_crawler\zhihu.json", "r", encoding="utf8") as f:
-            self.settings = json.load(f)  # Load settings
-        logger.info("Settings loaded")
 
 
-    def sleep(self, sleep_key, delta=0):
+class TokenBucket:
+    """
+    A thread-safe token bucket limiting how fast requests are sent
+
+    :param rate: tokens refilled per second
+    :param burst: maximum number of tokens the bucket can hold
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
         """
-        Execute sleeping for a time configured in the settings
+        Block until a token is available, then take it
 
-        :param sleep_key: the sleep time label
-        :param delta: added to the sleep time
-        :return:
         """
-        _t = self.settings["config"][sleep_key] + delta
-        logger.info(f"Sleep {_t} second(s)")
-        time.sleep(_t)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
-    def query(self, sql, args=None, op=None):
+
+class Schedule:
+    """
+    Ticks on a fixed wall-clock grid, every `interval` seconds since the epoch
+
+    A tick that passes while the caller is still busy is skipped, not fired late, so the grid never drifts.
+
+    :param name: name of the schedule, for logs and metrics
+    :param interval: seconds between ticks
+    """
+
+    def __init__(self, name: str, interval: float):
+        self.name = name
+        self.interval = interval
+        self.next = self.align(time.time())
+
+    def align(self, now: float) -> float:
         """
-        Execute an SQL query
+        :return: the first tick at or after `now`
+        """
+        return math.ceil(now / self.interval) * self.interval
 
-        :param sql: the SQL query to execute
-        :param args: the arguments in the query
-        :param op: the operation to cursor after query
-        :return: op(cur)
+    def wait(self):
+        """
+        Sleep until the next tick
+
+        """
+        delay = max(self.next - time.time(), 0)
+        logger.info(f"Sleep {delay:.1f} second(s) until the next {self.name} tick")
+        metrics.observe("zhihu_stage_seconds", delay, stage=f"sleep_{self.name}")
+        time.sleep(delay)
+
+    def advance(self):
+        """
+        Move on after firing the next tick
+
+        """
+        self.next += self.interval
+
+    def catch_up(self, now: float) -> int:
+        """
+        Skip the ticks that passed before `now`
+
+        :return: number of ticks skipped
+        """
+        if self.next >= now:
+            return 0
+        following = self.align(now)
+        skipped = round((following - self.next) / self.interval)
+        logger.warning(f"Skipped {skipped} {self.name} tick(s), the previous crawl overran")
+        metrics.inc("zhihu_skipped_ticks_total", skipped, schedule=self.name)
+        self.next = following
+        return skipped
+
+
+class ConnectionPool:
+    """
+    A bounded pool of long-lived MySQL connections, safe to share between threads
+
+    :param options: keyword arguments for `pymysql.connect`
+    :param size: maximum number of connections, in use and idle
+    :param recycle: connections older than this many seconds are closed and replaced
+    """
+
+    def __init__(self, options: dict, size: int = 8, recycle: float = 3600):
+        self.options = options
+        self.size = size
+        self.recycle = recycle
+        self.idle = []  # (connection, created time), most recently used last
+        self.in_use = 0
+        self.created = 0
+        self.recycled = 0
+        self.cond = threading.Condition()
+
+    def connect(self):
+        """
+        Open a new connection
+
+        :return: (connection, created time)
         """
         conn = pymysql.connect(
             cursorclass=pymysql.cursors.DictCursor,
             client_flag=pymysql.constants.CLIENT.MULTI_STATEMENTS,
-            **self.settings['mysql']
+            **self.options
         )
-        if args and not (isinstance(args, tuple) or isinstance(args, list)):
-            args = (args,)
-        with conn:
-            with conn.cursor() as cur:
-                try:
-                    cur.execute(sql, args)
-                    conn.commit()
-                    if op is not None:
-                        return op(cur)
-                except:  # Log query then exit
-                    if hasattr(cur, "_last_executed"):
-                        logger.error("Exception @ " + cur._last_executed)
-                    else:
-                        logger.error("Exception @ " + sql)
-                    raise
+        with self.cond:
+            self.created += 1
+        return conn, time.time()
 
-    def watch(self, top=None):
+    def discard(self, conn):
         """
-        The crawling flow
+        Close a connection that will not be returned to the pool
 
-        :param top: only look at the first `top` entries in the board. It can be used when debugging
-        :return:
         """
-        self.create_table()
-        while True:
-            logger.info("Begin crawling ...")
-            try:
-                crawl_id = None
-                begin_time = time.time()
-                crawl_id = self.begin_crawl(begin_time)
+        with self.cond:
+            self.recycled += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
 
-                try:
-                    board_entries = self.get_board()
-                except RuntimeError as e:
-                    if isinstance(e.args[0], requests.Response):
-                        logger.exception(e.args[0].status_code, e.args[0].text)
-                    raise
-                else:
-                    logger.info(
-                        f"Get {len(board_entries)} items: {','.join(map(lambda x: x['title'][:20], board_entries))}")
-                if top:
-                    board_entries = board_entries[:top]
+    def acquire(self):
+        """
+        Take a healthy connection from the pool, blocking while all `size` connections are in use
 
-                # Process each entry in the hot list
-                for idx, item in enumerate(board_entries):
-                    self.sleep("interval_between_question")
-                    detail = {
-                        "created": None,
-                        "visitCount": None,
-                        "followerCount": None,
-                        "answerCount": None,
-                        "raw": None,
-                        "hit_at": None
-                    }
-                    if item["qid"] is None:
-                        logger.warning(f"Unparsed URL @ {item['url']} ranking {idx} in crawl {crawl_id}.")
-                    else:
-                        try:
-                            detail = self.get_question(item["qid"])
-                        except Exception as e:
-                            if len(e.args) > 0 and isinstance(e.args[0], requests.Response):
-                                logger.exception(f"{e}; {e.args[0].status_code}; {e.args[0].text}")
-                            else:
-                                logger.exception(f"{str(e)}")
-                        else:
-                            logger.info(f"Get question detail for {item['title']}: raw detail length {len(detail['raw']) if detail['raw'] else 0}")
+        :return: (connection, created time)
+        """
+        with self.cond:
+            while not self.idle and self.in_use >= self.size:
+                self.cond.wait()
+            self.in_use += 1
+            entry = self.idle.pop() if self.idle else None
+        try:
+            if entry is not None:
+                conn, created = entry
+                if time.time() - created > self.recycle:
+                    self.discard(conn)
+                    entry = None
+                else:
                     try:
-                        self.add_entry(crawl_id, idx, item, detail)
-                    except Exception as e:
-                        logger.exception(f"Exception when adding entry {e}")
-                self.end_crawl(crawl_id)
-            except Exception as e:
-                logger.exception(f"Crawl {crawl_id} encountered an exception {e}. This crawl stopped.")
-            self.sleep("interval_between_board", delta=(begin_time - time.time()))
+                        conn.ping(reconnect=False)
+                    except Exception:  # Dropped by the server, replace it
+                        logger.warning("Discard a broken MySQL connection")
+                        self.discard(conn)
+                        entry = None
+            if entry is None:
+                entry = self.connect()
+        except BaseException:
+            with self.cond:
+                self.in_use -= 1
+                self.cond.notify()
+            raise
+        return entry
 
-    def create_table(self):
+    def release(self, entry, broken=False):
         """
-        Create tables to store the hot question records and crawl records
+        Return a connection to the pool
 
+        :param entry: (connection, created time) from `acquire`
+        :param broken: close the connection instead of keeping it
         """
-        sql = f"""
-CREATE TABLE IF NOT EXISTS `crawl` (
-    `id` BIGINT NOT NULL AUTO_INCREMENT,
-    `begin` DOUBLE NOT NULL,
-    `end` DOUBLE,
-    PRIMARY KEY (`id`) USING BTREE
-)
-AUTO_INCREMENT = 1 
-CHARACTER SET = utf8mb4 
-COLLATE = utf8mb4_unicode_ci;
+        if broken:
+            self.discard(entry[0])
+        with self.cond:
+            self.in_use -= 1
+            if not broken:
+                self.idle.append(entry)
+            self.cond.notify()
 
-CREATE TABLE IF NOT EXISTS `record`  (
-    `id` BIGINT NOT NULL AUTO_INCREMENT,
-    `qid` INT NOT NULL,
-    `crawl_id` BIGINT NOT NULL,
-    `hit_at` DOUBLE,
-    `ranking` INT NOT NULL,
-    `title` VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL ,
-    `heat` VARCHAR(20) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL,
-    `created` INT,
-    `visitCount` INT,
-    `followerCount` INT,
-    `answerCount` INT,
-    `excerpt` LONGTEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci,
-    `raw` LONGTEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci ,
-    `url` VARCHAR(255),
-    PRIMARY KEY (`id`) USING BTREE,
-    INDEX `CrawlAssociation` (`crawl_id`) USING BTREE,
-    CONSTRAINT `CrawlAssociationFK` FOREIGN KEY (`crawl_id`) REFERENCES `crawl` (`id`)
-) 
-AUTO_INCREMENT = 1 
-CHARACTER SET = utf8mb4 
-COLLATE = utf8mb4_unicode_ci;
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a `with` block
 
-"""
-        self.query(sql)
+        The transaction is rolled back if the block raises, and the connection is dropped if even that fails.
+        """
+        entry = self.acquire()
+        try:
+            yield entry[0]
+        except BaseException:
+            try:
+                entry[0].rollback()
+            except Exception:
+                self.release(entry, broken=True)
+            else:
+                self.release(entry)
+            raise
+        else:
+            self.release(entry)
 
-    def begin_crawl(self, begin_time) -> (int,float):
+    def stats(self) -> dict:
         """
-        Mark the beginning of a crawl
-        :param begin_time:
-        :return: (Crawl ID, the time marked when crawl begin)
+        Current state of the pool
+
+        :return: dict of in use / idle connection counts and total created / recycled connections
         """
-        sql = """
-INSERT INTO crawl (begin) VALUES(%s);
-"""
-        return self.query(sql, begin_time, lambda x: x.lastrowid)
+        with self.cond:
+            return {
+                "in_use": self.in_use,
+                "idle": len(self.idle),
+                "created": self.created,
+                "recycled": self.recycled,
+            }
 
-    def end_crawl(self, crawl_id: int):
+    def close(self):
         """
-        Mark the ending time of a crawl
+        Close all idle connections
 
-        :param crawl_id: Crawl ID
         """
-        sql = """
-UPDATE crawl SET end = %s WHERE id = %s;
-"""
-        self.query(sql, (time.time(), crawl_id))
+        with self.cond:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
 
- 
 
-    def add_entry(self, crawl_id, idx, board, detail):
+_timing = threading.local()  # Connection timings of the current thread's request
+
+
+class TimedConnectionMixin:
+    """
+    Record DNS, TCP and TLS time of new connections into `_timing`
+
+    """
+
+    def _new_conn(self):
+        host = self._dns_host
+        t0 = time.perf_counter()
+        try:
+            addresses = list(dict.fromkeys(
+                info[4][0] for info in socket.getaddrinfo(host, self.port, allowed_gai_family(), socket.SOCK_STREAM)))
+        except socket.gaierror as e:
+            raise NewConnectionError(self, f"Failed to resolve {host}: {e}") from e
+        t1 = time.perf_counter()
+        # Connect to the resolved addresses in turn, as urllib3 would; SNI still uses the host name
+        for i, address in enumerate(addresses):
+            self._dns_host = address
+            try:
+                sock = super()._new_conn()
+                break
+            except ConnectTimeoutError:  # Also NewConnectionError
+                if i == len(addresses) - 1:
+                    raise
+            finally:
+                self._dns_host = host
+        _timing.dns = t1 - t0
+        _timing.tcp = time.perf_counter() - t1
+        return sock
+
+    def connect(self):
+        t0 = time.perf_counter()
+        super().connect()
+        _timing.connect = time.perf_counter() - t0
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    An HTTPAdapter whose pooled connections record their set-up time
+
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool,
+        }
+
+
+class HttpClient:
+    """
+    A keep-alive HTTP session shared by all fetches of the crawler
+
+    Headers and cookies are loaded once from the settings. Every response gets a `timing` dict
+    with the seconds spent on DNS, TCP connect, TLS, time to first byte and body, and the bytes received.
+
+    :param headers: default headers; a `Cookie` header is moved into the session's cookie jar
+    :param config: the `config` section of the settings
+    """
+
+    def __init__(self, headers: dict, config: dict):
+        self.session = requests.Session()
+        headers = dict(headers)
+        cookie = headers.pop("Cookie", "")
+        for pair in cookie.split(";"):
+            name, sep, value = pair.strip().partition("=")
+            if sep:
+                self.session.cookies.set(name, value, domain=".zhihu.com")
+        headers["Accept-Encoding"] = ACCEPT_ENCODING  # gzip, deflate, and br when brotli is installed
+        self.session.headers.update(headers)
+
+        retry = Retry(
+            total=config.get("http_retries", 2),
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+        )
+        adapter = TimedHTTPAdapter(pool_connections=4, pool_maxsize=max(config.get("workers", 1), 1), max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.timeout = (config.get("connect_timeout", 5), config.get("read_timeout", 15))
+
+    def get(self, url, **kwargs) -> requests.Response:
         """
-        Add a question entry to database
+        GET a URL through the shared session
 
-        :param crawl_id: Crawl ID
-        :param idx: Ranking in the board
-        :param board: dict, info from the board
-        :param detail: dict, info from the detail page
+        :param url: the URL to fetch
+        :return: the response, with its body read and `timing` attached
         """
-        sql = \
-            """
-INSERT INTO record (`qid`, `crawl_id`, `title`, `heat`, `created`, `visitCount`, `followerCount`, `answerCount`,`excerpt`, `raw`, `ranking`, `hit_at`, `url`)
-VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-"""
-        self.query(
-            sql,
-            (
-                board["qid"],
-                crawl_id,
-                board["title"],
-                board["heat"],
-                detail["created"],
-                detail["visitCount"],
-                detail["followerCount"],
-                detail["answerCount"],
-                board["excerpt"],
-                detail["raw"],
-                idx,
-                detail["hit_at"],
-                board["url"]
-            )
+        _timing.__dict__.clear()
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        resp = self.session.get(url, stream=True, **kwargs)
+        headers_at = time.perf_counter()
+        body = resp.content
+        end = time.perf_counter()
+
+        dns = getattr(_timing, "dns", 0.0)
+        tcp = getattr(_timing, "tcp", 0.0)
+        connect = getattr(_timing, "connect", 0.0)
+        resp.timing = {
+            "dns": dns,
+            "connect": tcp,
+            "tls": max(connect - dns - tcp, 0.0),
+            "ttfb": headers_at - start - connect,
+            "body": end - headers_at,
+            "total": end - start,
+            "reused": connect == 0.0,
+            "bytes": resp.raw.tell() if hasattr(resp.raw, "tell") else len(body),
+        }
+        metrics.inc("zhihu_http_responses_total", status=resp.status_code)
+        metrics.inc("zhihu_http_bytes_total", resp.timing["bytes"])
+        retries = getattr(resp.raw, "retries", None)
+        if retries is not None and retries.history:
+            metrics.inc("zhihu_http_retries_total", len(retries.history))
+        for phase in ("dns", "connect", "tls", "ttfb", "body"):
+            if phase in ("ttfb", "body") or not resp.timing["reused"]:
+                metrics.observe("zhihu_http_phase_seconds", resp.timing[phase], phase=phase)
+        logger.debug(
+            f"GET {url} {resp.status_code}: " + ", ".join(
+                f"{k} {v * 1000:.1f}ms" for k, v in resp.timing.items() if isinstance(v, float)
+            ) + f", {resp.timing['bytes']} bytes{' (reused)' if resp.timing['reused'] else ''}"
         )
+        return resp
+
+    def close(self):
+        self.session.close()
+
+
+class DetailCache:
+    """
+    An LRU cache of question details with a TTL, shared by the fetching threads
+
+    Each entry remembers when and at what heat the detail was fetched, its response size, and how many
+    refreshes in a row found it unchanged, counters included.
+
+    :param capacity: maximum number of questions kept
+    :param ttl: entries older than this many seconds are dropped
+    """
+
+    STABLE_KEYS = ("title", "raw", "created", "visitCount", "followerCount", "answerCount")
+
+    def __init__(self, capacity: int = 2000, ttl: float = 21600):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()  # qid -> entry, least recently used first
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def get(self, qid):
+        """
+        :return: the cached entry of `qid`, or None if absent or expired
+        """
+        with self.lock:
+            entry = self.entries.get(qid)
+            if entry is None:
+                return None
+            if time.time() - entry["fetched_at"] > self.ttl:
+                del self.entries[qid]
+                return None
+            self.entries.move_to_end(qid)
+            return entry
+
+    def put(self, qid, detail: dict, heat, size: int):
+        """
+        Store a freshly fetched detail
+
+        :param qid: Question ID
+        :param detail: the detail from `get_question`
+        :param heat: heat of the question on the board when fetched, in units of 万
+        :param size: bytes downloaded for the detail
+        """
+        with self.lock:
+            old = self.entries.pop(qid, None)
+            stable = 0
+            if old is not None and all(old["detail"].get(k) == detail.get(k) for k in self.STABLE_KEYS):
+                stable = old["stable"] + 1
+            self.entries[qid] = {"detail": detail, "fetched_at": time.time(), "heat": heat, "size": size, "stable": stable}
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def record(self, entry=None):
+        """
+        Count a hit on `entry`, or a miss if it is None
+
+        """
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += entry["size"]
+
+
+class QuestionWindow:
+    """
+    The metrics of one question in its appearances among the recent crawls, as a ring of float arrays
+
+    Empty slots and missing values are NaN. Slots are in ring order; use `ordered` for time order.
+
+    :param size: number of slots
+    """
+    __slots__ = ("at", "values", "start", "count")
+
+    def __init__(self, size: int):
+        self.at = array("d", [math.nan] * size)
+        self.values = [array("d", [math.nan] * size) for _ in WINDOW_METRICS]
+        self.start = 0
+        self.count = 0
+
+    def append(self, at: float, row: dict):
+        """
+        Add an appearance, overwriting the oldest one when full
+
+        :param at: time of the crawl
+        :param row: record row, with the keys in `WINDOW_METRICS`
+        """
+        size = len(self.at)
+        i = (self.start + self.count) % size
+        if self.count == size:
+            self.start = (self.start + 1) % size
+        else:
+            self.count += 1
+        self.at[i] = at
+        for values, metric in zip(self.values, WINDOW_METRICS):
+            values[i] = math.nan if row[metric] is None else row[metric]
+
+    def ordered(self, values: array) -> list:
+        """
+        :return: the filled slots of `values`, oldest first
+        """
+        size = len(values)
+        return [values[(self.start + i) % size] for i in range(self.count)]
+
+    def slope(self, metric: int):
+        """
+        Least-squares change of a metric per second
+
+        :param metric: index in `WINDOW_METRICS`
+        :return: the slope, or None with less than two values
+        """
+        points = [(t, v) for t, v in zip(self.at, self.values[metric]) if not (math.isnan(t) or math.isnan(v))]
+        if len(points) < 2:
+            return None
+        t_mean = sum(t for t, _ in points) / len(points)
+        v_mean = sum(v for _, v in points) / len(points)
+        var = sum((t - t_mean) ** 2 for t, _ in points)
+        if not var:
+            return None
+        return sum((t - t_mean) * (v - v_mean) for t, v in points) / var
+
+
+class RecentWindow:
+    """
+    Metrics of the questions seen in the last `size` crawls, kept in memory for "rising fastest" rankings
+
+    Each question has a `QuestionWindow` of its appearances. Questions absent from all of the last `size` crawls
+    are dropped. Velocities are least-squares slopes over the window, per hour; with numpy installed, `movers`
+    computes all of them at once.
+
+    :param size: number of crawls kept
+    """
+
+    def __init__(self, size: int = 12):
+        self.size = max(size, 1)
+        self.crawls = deque(maxlen=self.size)  # Times of the crawls in the window
+        self.questions = {}  # qid -> QuestionWindow
+        self.lock = threading.Lock()
+
+    def add(self, at: float, rows: list):
+        """
+        Add a crawl
+
+        :param at: time of the crawl
+        :param rows: record rows of the crawl
+        """
+        with self.lock:
+            self.crawls.append(at)
+            for row in rows:
+                if not row["qid"]:
+                    continue
+                window = self.questions.get(row["qid"])
+                if window is None:
+                    window = self.questions[row["qid"]] = QuestionWindow(self.size)
+                window.append(at, row)
+            oldest = self.crawls[0]
+            for qid in [qid for qid, window in self.questions.items()
+                        if window.at[(window.start + window.count - 1) % self.size] < oldest]:
+                del self.questions[qid]
+
+    def deltas(self, qid: int, metric: str = "heat_w") -> list:
+        """
+        Changes of a metric between consecutive appearances of a question
+
+        :return: list of (time, change since the previous appearance), oldest first
+        """
+        with self.lock:
+            window = self.questions.get(qid)
+            if window is None:
+                return []
+            at, values = window.ordered(window.at), window.ordered(window.values[WINDOW_METRICS.index(metric)])
+        return [(at[i], values[i] - values[i - 1]) for i in range(1, len(at))]
+
+    def velocity(self, qid: int, metric: str = "heat_w"):
+        """
+        :return: change of a metric per hour over the window, or None if the question has less than two values
+        """
+        with self.lock:
+            window = self.questions.get(qid)
+            slope = None if window is None else window.slope(WINDOW_METRICS.index(metric))
+        return None if slope is None else slope * 3600
+
+    def movers(self, metric: str = "heat_w", k: int = 10) -> list:
+        """
+        The questions whose metric rises fastest
+
+        :param metric: one of `WINDOW_METRICS`
+        :param k: number of questions
+        :return: list of (qid, change per hour), fastest first
+        """
+        index = WINDOW_METRICS.index(metric)
+        with self.lock:
+            qids = list(self.questions)
+            windows = [self.questions[qid] for qid in qids]
+            if np is None:
+                slopes = [window.slope(index) for window in windows]
+                ranked = sorted(((s * 3600, qid) for qid, s in zip(qids, slopes) if s is not None), reverse=True)
+                return [(qid, v) for v, qid in ranked[:k]]
+            if not windows:
+                return []
+            t = np.vstack([np.frombuffer(window.at) for window in windows])
+            v = np.vstack([np.frombuffer(window.values[index]) for window in windows])
+        valid = ~(np.isnan(t) | np.isnan(v))
+        n = valid.sum(axis=1)
+        t_mean = np.where(valid, t, 0).sum(axis=1) / np.maximum(n, 1)
+        v_mean = np.where(valid, v, 0).sum(axis=1) / np.maximum(n, 1)
+        dt = np.where(valid, t - t_mean[:, None], 0)
+        var = (dt ** 2).sum(axis=1)
+        cov = (dt * np.where(valid, v - v_mean[:, None], 0)).sum(axis=1)
+        slopes = np.where((n >= 2) & (var > 0), cov / np.where(var > 0, var, 1), np.nan) * 3600
+        order = [i for i in np.argsort(-np.nan_to_num(slopes, nan=-np.inf), kind="stable")[:k] if not np.isnan(slopes[i])]
+        return [(qids[i], float(slopes[i])) for i in order]
+
+
+class TitleTracker:
+    """
+    The last title seen of each question, telling subscribers when it changes
+
+    A question seen for the first time counts as a revision from no title (`old_title` None), so
+    `title_revision` holds the complete title history and the tracker can be loaded back from it.
+    """
+
+    def __init__(self):
+        self.titles = {}  # qid -> last title seen
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.loaded = False  # Nothing is observed before `load`, which would take every title for a new one
+
+    def load(self, titles: dict):
+        """
+        :param titles: dict of qid -> current title
+        """
+        with self.lock:
+            self.titles.update(titles)
+            self.loaded = True
+
+    def subscribe(self, callback):
+        """
+        Call `callback(revision)` for every title revision from now on, on the thread writing the crawl
+
+        :param callback: takes a revision dict as written to `title_revision`
+        """
+        self.subscribers.append(callback)
+
+    def observe(self, entries, crawl_id: int, at: float) -> list:
+        """
+        Compare the titles of a crawl with the last ones seen, and take its titles as the last ones
+
+        Call `publish` once the revisions are written, or `revert` if writing them failed, so they are seen again.
+
+        :param entries: dicts with `qid` and `title`, such as record rows or board entries
+        :param crawl_id: Crawl ID
+        :param at: time of the crawl
+        :return: the revisions, as rows of `title_revision`
+        """
+        revisions = []
+        with self.lock:
+            if not self.loaded:
+                return revisions
+            for entry in entries:
+                qid, title = entry["qid"], entry["title"]
+                if not qid or not title or self.titles.get(qid) == title:
+                    continue
+                revisions.append({"qid": qid, "crawl_id": crawl_id, "at": at,
+                                  "old_title": self.titles.get(qid), "title": title})
+                self.titles[qid] = title
+        return revisions
+
+    def revert(self, revisions: list):
+        """
+        Forget revisions from `observe` that could not be written
+
+        :param revisions: from `observe`
+        """
+        with self.lock:
+            for revision in reversed(revisions):
+                if self.titles.get(revision["qid"]) != revision["title"]:  # Retitled again since
+                    continue
+                if revision["old_title"] is None:
+                    del self.titles[revision["qid"]]
+                else:
+                    self.titles[revision["qid"]] = revision["old_title"]
+
+    def publish(self, revisions: list):
+        """
+        Count written revisions and pass them to the subscribers
+
+        :param revisions: from `observe`
+        """
+        if not revisions:
+            return
+        crawl_id = revisions[0]["crawl_id"]
+        changed = sum(revision["old_title"] is not None for revision in revisions)
+        if changed:
+            logger.info(f"Crawl {crawl_id}: {changed} question(s) retitled")
+            metrics.inc("zhihu_title_revisions_total", changed)
+        for revision in revisions:
+            for callback in self.subscribers:
+                try:
+                    callback(revision)
+                except Exception as e:
+                    logger.exception(f"Title revision subscriber failed: {e}")
+
+
+class SearchIndex:
+    """
+    An in-memory inverted index of characters and character bigrams over question titles, excerpts and details
+
+    Chinese text needs no word segmentation this way: a term of two or more characters is looked up by its
+    bigrams, then confirmed by a substring check on the question's texts, so every term matches like
+    `LIKE '%term%'`. Postings are per question, and each distinct text (by `content_hash`) is indexed once
+    per question, no matter how many crawls it appears in.
+    """
+    QUERY_TOKEN = re.compile(r'"([^"]*)"|(\S+)')
+
+    def __init__(self):
+        self.postings = {}  # gram -> set of qids
+        self.documents = {}  # qid -> set of hashes of its texts
+        self.texts = {}  # hash -> lowercased text
+        self.titles = {}  # qid -> last title
+        self.seen = {}  # qid -> [first, last] time seen
+        self.indexed_until = 0  # Crawls of the database ended up to this time are indexed
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def grams(text: str) -> set:
+        """
+        :return: the characters of `text` if it has one, else its bigrams
+        """
+        if len(text) < 2:
+            return set(text)
+        return {text[i:i + 2] for i in range(len(text) - 1)}
+
+    def add(self, qid: int, at: float, title: str, texts=()):
+        """
+        Index the texts of a question seen at some time
+
+        :param qid: Question ID
+        :param at: time it was seen
+        :param title: its title
+        :param texts: other texts, as (content hash or None, text); the text may be None if the hash is indexed
+        """
+        if not qid:
+            return
+        with self.lock:
+            seen = self.seen.get(qid)
+            if seen is None:
+                self.seen[qid] = [at, at]
+            else:
+                seen[0], seen[1] = min(seen[0], at), max(seen[1], at)
+            if at >= self.seen[qid][1]:
+                self.titles[qid] = title
+            documents = self.documents.setdefault(qid, set())
+            for digest, text in ((None, title),) + tuple(texts):
+                if text is None and digest not in self.texts:
+                    continue
+                if digest is None:
+                    digest = content_hash(text)
+                if digest in documents:
+                    continue
+                documents.add(digest)
+                lowered = self.texts.get(digest)
+                if lowered is None:
+                    lowered = self.texts[digest] = text.lower()
+                for gram in self.grams(lowered) | set(lowered):
+                    self.postings.setdefault(gram, set()).add(qid)
+
+    def parse(self, query: str) -> list:
+        """
+        Parse a query: terms are ANDed, `OR` separates alternatives, and "quoted phrases" may contain spaces
+
+        :return: list of alternatives, each a list of lowercased terms
+        """
+        alternatives = [[]]
+        for phrase, word in self.QUERY_TOKEN.findall(query):
+            if word == "OR":
+                alternatives.append([])
+            elif word != "AND" and (phrase or word):
+                alternatives[-1].append((phrase or word).lower())
+        return [terms for terms in alternatives if terms]
+
+    def match(self, term: str) -> set:
+        """
+        :return: qids whose texts contain `term`
+        """
+        postings = sorted((self.postings.get(gram, set()) for gram in self.grams(term)), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:]) if postings else set()
+        if len(term) <= 2:
+            return candidates
+        return {qid for qid in candidates if any(term in self.texts[digest] for digest in self.documents[qid])}
+
+    def search(self, query: str, qids=None, since=None, until=None, limit=50) -> list:
+        """
+        Find questions by their texts
+
+        :param query: see `parse`
+        :param qids: only among these questions
+        :param since: only questions seen at or after this time
+        :param until: only questions seen at or before this time
+        :param limit: maximum number of results
+        :return: list of (qid, title), most recently seen first
+        """
+        found = set()
+        with self.lock:
+            for terms in self.parse(query):
+                matched = None
+                for term in sorted(terms, key=len, reverse=True):  # Longer terms have shorter postings
+                    matched = self.match(term) if matched is None else matched & self.match(term)
+                    if not matched:
+                        break
+                found |= matched
+            if qids is not None:
+                found &= set(qids)
+            if since is not None:
+                found = {qid for qid in found if self.seen[qid][1] >= since}
+            if until is not None:
+                found = {qid for qid in found if self.seen[qid][0] <= until}
+            ranked = sorted(found, key=lambda qid: self.seen[qid][1], reverse=True)[:limit]
+            return [(qid, self.titles[qid]) for qid in ranked]
+
+    def save(self, path: str):
+        """
+        Write a snapshot of the index
+
+        """
+        with self.lock:
+            state = {k: getattr(self, k) for k in ("postings", "documents", "texts", "titles", "seen", "indexed_until")}
+            with open(path + ".tmp", "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path: str):
+        """
+        Replace the index with a snapshot from `save`
+
+        """
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        with self.lock:
+            for k, v in state.items():
+                setattr(self, k, v)
+
+
+class Spool:
+    """
+    A durable append-only log of finished crawls, one JSON line per crawl
+
+    Crawls are appended and fsync'ed as one write each, and read back by the drainer from the position kept
+    in `spool.offset`. Once everything is drained the log is truncated. A line cut short by a crash is dropped
+    when the spool is opened.
+
+    :param directory: where `spool.jsonl` and `spool.offset` are kept
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "spool.jsonl")
+        self.offset_path = os.path.join(directory, "spool.offset")
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+        self.offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path, "r") as f:
+                self.offset = int(f.read() or 0)
+        self.pending = deque()  # End times of the crawls not drained yet
+        with open(self.path, "ab+") as f:
+            f.seek(0)
+            end = 0
+            for line in f:
+                if not line.endswith(b"\n"):  # Drop a partly written last line
+                    f.truncate(end)
+                    break
+                if end >= self.offset:
+                    self.pending.append(json.loads(line)["crawl"]["end"])
+                end += len(line)
+        if self.offset > end:  # Truncated after draining, before the offset was saved
+            self.offset = 0
+        self.file = open(self.path, "ab")
+
+    def append(self, crawl: dict, rows: list):
+        """
+        Durably add a finished crawl
+
+        :param crawl: dict of the crawl's `id`, `begin` and `end`
+        :param rows: record rows of the crawl
+        """
+        line = (json.dumps({"crawl": crawl, "rows": rows}, ensure_ascii=False) + "\n").encode("utf8")
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending.append(crawl["end"])
+        self.wakeup.set()
+
+    def read(self, limit: int):
+        """
+        Read crawls not drained yet
+
+        :param limit: maximum number of crawls
+        :return: list of (crawl, rows), and the position after them to `commit` once they are written
+        """
+        crawls, offset = [], self.offset
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                if len(crawls) >= limit or not line.endswith(b"\n"):
+                    break
+                entry = json.loads(line)
+                crawls.append((entry["crawl"], entry["rows"]))
+                offset += len(line)
+        return crawls, offset
+
+    def commit(self, offset: int, count: int):
+        """
+        Mark the crawls before `offset` as written to the database
+
+        :param count: number of crawls drained
+        """
+        with self.lock:
+            for _ in range(count):
+                self.pending.popleft()
+            if offset == self.file.tell():  # All drained, start over
+                self.file.truncate(0)
+                self.file.seek(0)
+                offset = 0
+            self.offset = offset
+            with open(self.offset_path + ".tmp", "w") as f:
+                f.write(str(offset))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.offset_path + ".tmp", self.offset_path)
+
+    def stats(self) -> dict:
+        """
+        :return: dict of crawls and bytes waiting in the spool, and the age in seconds of the oldest one
+        """
+        with self.lock:
+            return {
+                "crawls": len(self.pending),
+                "bytes": self.file.tell() - self.offset,
+                "lag": time.time() - self.pending[0] if self.pending else 0.0,
+            }
+
+
+class MySQLStorage:
+    """
+    Crawls stored in MySQL through a pool of connections: the reference storage, with rollups, deduplicated
+    texts and everything the coordinator / worker mode, `export` and the bulk imports need
+
+    All storages have `create_table`, `begin_crawl`, `write_crawls`, `query` and `transaction`, the last two taking
+    pymysql placeholders. Statements using MySQL-only syntax still need the MySQL storage.
+
+    :param options: keyword arguments for `pymysql.connect`
+    :param config: the `config` section of the settings
+    """
+
+    def __init__(self, options: dict, config: dict):
+        self.config = config
+        self.pool = ConnectionPool(
+            options,
+            size=config.get("mysql_pool_size", 8),
+            recycle=config.get("mysql_pool_recycle", 3600)
+        )
+        self.known_contents = set()  # Hashes already committed to `content`
+        metrics.gauge("zhihu_mysql_connections", "MySQL connections of the pool by state",
+                      lambda: {(("state", k),): v for k, v in self.pool.stats().items() if k in ("in_use", "idle")})
+        metrics.gauge("zhihu_mysql_connection_events", "MySQL connections created / recycled by the pool",
+                      lambda: {(("event", k),): v for k, v in self.pool.stats().items() if k in ("created", "recycled")})
+
+    @timed("query")
+    def query(self, sql, args=None, op=None):
+        """
+        Execute an SQL query
+
+        :param sql: the SQL query to execute
+        :param args: the arguments in the query
+        :param op: the operation to cursor after query
+        :return: op(cur)
+        """
+        if args and not (isinstance(args, tuple) or isinstance(args, list)):
+            args = (args,)
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                try:
+                    cur.execute(sql, args)
+                    conn.commit()
+                    if op is not None:
+                        return op(cur)
+                except:  # Log query then exit
+                    if hasattr(cur, "_last_executed"):
+                        logger.error("Exception @ " + cur._last_executed)
+                    else:
+                        logger.error("Exception @ " + sql)
+                    raise
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run several statements on one connection and commit them together
+
+        Nothing is committed if the `with` block raises.
+
+        :return: a cursor of the transaction
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                try:
+                    yield cur
+                except:  # Log query then exit
+                    if getattr(cur, "_last_executed", None):
+                        logger.error("Exception @ " + cur._last_executed[:1000])
+                    raise
+            conn.commit()
+
+    def create_table(self):
+        """
+        Create tables to store the hot question records and crawl records, and bring existing ones up to date
+
+        """
+        sql = """
+CREATE TABLE IF NOT EXISTS `crawl` (
+    `id` BIGINT NOT NULL AUTO_INCREMENT,
+    `begin` DOUBLE NOT NULL,
+    `end` DOUBLE,
+    `spool_key` BIGINT,
+    PRIMARY KEY (`id`) USING BTREE,
+    UNIQUE INDEX `SpoolKey` (`spool_key`) USING BTREE
+)
+AUTO_INCREMENT = 1 
+CHARACTER SET = utf8mb4 
+COLLATE = utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `record`  (
+    `id` BIGINT NOT NULL AUTO_INCREMENT,
+    `qid` INT NOT NULL,
+    `crawl_id` BIGINT NOT NULL,
+    `hit_at` DOUBLE,
+    `ranking` INT NOT NULL,
+    `title` VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL ,
+    `heat` VARCHAR(20) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL,
+    `heat_w` INT,
+    `created` INT,
+    `visitCount` INT,
+    `followerCount` INT,
+    `answerCount` INT,
+    `excerpt` LONGTEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci,
+    `raw` LONGTEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci ,
+    `excerpt_hash` CHAR(40) CHARACTER SET ascii,
+    `raw_hash` CHAR(40) CHARACTER SET ascii,
+    `url` VARCHAR(255),
+    PRIMARY KEY (`id`) USING BTREE,
+    INDEX `CrawlAssociation` (`crawl_id`) USING BTREE,
+    INDEX `QuestionTime` (`qid`, `hit_at`) USING BTREE,
+    INDEX `Title` (`title`) USING BTREE,
+    INDEX `VisitCount` (`visitCount`) USING BTREE,
+    INDEX `Heat` (`heat_w`) USING BTREE,
+    UNIQUE INDEX `CrawlRanking` (`crawl_id`, `ranking`) USING BTREE,
+    CONSTRAINT `CrawlAssociationFK` FOREIGN KEY (`crawl_id`) REFERENCES `crawl` (`id`)
+) 
+AUTO_INCREMENT = 1 
+CHARACTER SET = utf8mb4 
+COLLATE = utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `content` (
+    `hash` CHAR(40) CHARACTER SET ascii NOT NULL,
+    `body` LONGBLOB NOT NULL,
+    `length` INT NOT NULL,
+    PRIMARY KEY (`hash`) USING BTREE
+)
+CHARACTER SET = utf8mb4
+COLLATE = utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `title_revision` (
+    `id` BIGINT NOT NULL AUTO_INCREMENT,
+    `qid` INT NOT NULL,
+    `crawl_id` BIGINT NOT NULL,
+    `at` DOUBLE NOT NULL,
+    `old_title` VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci,
+    `title` VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL,
+    PRIMARY KEY (`id`) USING BTREE,
+    INDEX `QuestionTime` (`qid`, `at`) USING BTREE,
+    INDEX `Time` (`at`) USING BTREE
+)
+AUTO_INCREMENT = 1
+CHARACTER SET = utf8mb4
+COLLATE = utf8mb4_unicode_ci;
+
+CREATE TABLE IF NOT EXISTS `crawl_job` (
+    `crawl_id` BIGINT NOT NULL,
+    `ranking` INT NOT NULL,
+    `board` TEXT CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci NOT NULL,
+    `done` TINYINT NOT NULL DEFAULT 0,
+    `lease` CHAR(32) CHARACTER SET ascii,
+    `lease_until` DOUBLE,
+    `worker` VARCHAR(64),
+    `attempts` INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (`crawl_id`, `ranking`) USING BTREE,
+    INDEX `Pending` (`done`, `lease_until`) USING BTREE,
+    INDEX `Lease` (`lease`) USING BTREE
+)
+CHARACTER SET = utf8mb4
+COLLATE = utf8mb4_unicode_ci;
+
+"""
+        self.query(sql)
+        self.create_rollup_tables()
+        self.migrate()
+        self.create_views()
+        if not self.query("SELECT 1 FROM title_revision LIMIT 1;", op=lambda cur: cur.fetchone()):
+            count = self.backfill_revisions()
+            logger.info(f"Migrate: {count} title revision(s) filled from record")
+
+    def backfill_revisions(self, chunk=1000):
+        """
+        Fill `title_revision` from the history in `record`, as `BACKFILL_REVISIONS_SQL` but working on MySQL 5.7
+
+        Records are read `chunk` questions at a time; the revisions are inserted in one transaction at the end.
+
+        :return: number of revisions
+        """
+        qids = self.query("SELECT DISTINCT qid FROM record ORDER BY qid;", op=lambda cur: [r["qid"] for r in cur.fetchall()])
+        revisions = []
+        for i in range(0, len(qids), chunk):
+            rows = self.query(
+                "SELECT r.qid, r.crawl_id, c.begin AS at, r.title FROM record r JOIN crawl c ON c.id = r.crawl_id "
+                "WHERE r.qid BETWEEN %s AND %s ORDER BY r.qid, r.crawl_id, r.id;",
+                (qids[i], qids[min(i + chunk, len(qids)) - 1]), lambda cur: cur.fetchall()
+            )
+            last = {}
+            for row in rows:
+                if last.get(row["qid"]) != row["title"]:
+                    revisions.append(dict(row, old_title=last.get(row["qid"])))
+                    last[row["qid"]] = row["title"]
+        batch = self.config.get("batch_size", 500)
+        with self.transaction() as cur:
+            for i in range(0, len(revisions), batch):
+                cur.executemany(INSERT_REVISION_SQL, revisions[i:i + batch])
+        return len(revisions)
+
+    def create_rollup_tables(self):
+        """
+        Create the per-question rollups of `record`, one row per question and hour / day
+
+        `bucket` is the start of the hour / day (local to `rollup_utc_offset`) as a timestamp. For each metric
+        in `ROLLUP_METRICS` the minimum, maximum and latest value in the bucket are kept.
+        """
+        metrics = "".join(
+            f"    `{m}_{agg}` {'BIGINT' if m != 'ranking' else 'INT'},\n"
+            for m in ROLLUP_METRICS for agg in ("min", "max", "last")
+        )
+        for table in ROLLUP_TABLES:
+            self.query(f"""
+CREATE TABLE IF NOT EXISTS `{table}` (
+    `qid` INT NOT NULL,
+    `bucket` BIGINT NOT NULL,
+    `appearances` INT NOT NULL,
+    `last_at` DOUBLE NOT NULL,
+{metrics}    PRIMARY KEY (`qid`, `bucket`) USING BTREE,
+    INDEX `Bucket` (`bucket`) USING BTREE
+)
+CHARACTER SET = utf8mb4
+COLLATE = utf8mb4_unicode_ci;
+""")
+        self.query("""
+CREATE TABLE IF NOT EXISTS `watermark` (
+    `name` VARCHAR(64) CHARACTER SET ascii NOT NULL,
+    `value` DOUBLE NOT NULL,
+    PRIMARY KEY (`name`) USING BTREE
+);
+""")
+
+    def get_watermark(self, name):
+        """
+        :param name: e.g. "downsampled_until"
+        :return: the value saved by `set_watermark`, or None
+        """
+        row = self.query("SELECT value FROM watermark WHERE name = %s;", name, lambda cur: cur.fetchone())
+        return row["value"] if row else None
+
+    def set_watermark(self, cur, name, value):
+        """
+        :param cur: cursor of an open transaction, so the watermark moves together with what it marks
+        :param name: e.g. "downsampled_until"
+        :param value: timestamp
+        """
+        cur.execute("INSERT INTO watermark (name, value) VALUES (%s, %s) ON DUPLICATE KEY UPDATE value = VALUES(value);",
+                    (name, value))
+
+    # Columns added to `record` after its first release: name -> definition
+    RECORD_MIGRATIONS = {
+        "heat_w": "INT AFTER `heat`",
+        "excerpt_hash": "CHAR(40) CHARACTER SET ascii AFTER `raw`",
+        "raw_hash": "CHAR(40) CHARACTER SET ascii AFTER `excerpt_hash`",
+    }
+    # Secondary indexes of `record`: name -> (kind, columns)
+    RECORD_INDEXES = {
+        "QuestionTime": ("INDEX", "(`qid`, `hit_at`)"),  # Trend of a question
+        "Title": ("INDEX", "(`title`)"),  # Appearances per title, keyword lookups
+        "VisitCount": ("INDEX", "(`visitCount`)"),  # Most visited record
+        "Heat": ("INDEX", "(`heat_w`)"),  # Hottest records
+        "CrawlRanking": ("UNIQUE INDEX", "(`crawl_id`, `ranking`)"),  # Idempotent replay of spooled crawls
+    }
+
+    def migrate(self):
+        """
+        Bring the `record` table of an existing database up to the current layout
+
+        Missing columns and indexes are added, and `heat_w` is filled in for rows written before it existed.
+        `crawl` gets its `spool_key` column, see `store_crawl`.
+        """
+        if not self.query("SHOW COLUMNS FROM crawl LIKE 'spool_key';", op=lambda cur: cur.fetchone()):
+            logger.info("Migrate: add column crawl.spool_key")
+            self.query("ALTER TABLE crawl ADD COLUMN `spool_key` BIGINT AFTER `end`, "
+                       "ADD UNIQUE INDEX `SpoolKey` (`spool_key`) USING BTREE;")
+        existing = {
+            row["COLUMN_NAME"] for row in self.query(
+                "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'record';",
+                op=lambda cur: cur.fetchall()
+            )
+        }
+        for name, definition in self.RECORD_MIGRATIONS.items():
+            if name not in existing:
+                logger.info(f"Migrate: add column record.{name}")
+                self.query(f"ALTER TABLE record ADD COLUMN `{name}` {definition};")
+        if "heat_w" not in existing:
+            self.backfill_heat()
+
+        indexes = {
+            row["INDEX_NAME"] for row in self.query(
+                "SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'record';",
+                op=lambda cur: cur.fetchall()
+            )
+        }
+        missing = [name for name in self.RECORD_INDEXES if name not in indexes]
+        if missing:
+            logger.info(f"Migrate: add index {', '.join(missing)} on record")
+            self.query(
+                "ALTER TABLE record " +
+                ", ".join(f"ADD {self.RECORD_INDEXES[name][0]} `{name}` {self.RECORD_INDEXES[name][1]} USING BTREE"
+                          for name in missing) + ";"
+            )
+
+    def backfill_heat(self):
+        """
+        Fill `heat_w` from the `heat` text for existing rows, the same way as `parse_heat`
+
+        """
+        sql = """
+UPDATE record SET heat_w = CASE
+    WHEN heat LIKE '%亿%' THEN ROUND(CAST(SUBSTRING_INDEX(REPLACE(heat, ' ', ''), '亿', 1) AS DECIMAL(12, 2)) * 10000)
+    WHEN heat LIKE '%万%' THEN ROUND(CAST(SUBSTRING_INDEX(REPLACE(heat, ' ', ''), '万', 1) AS DECIMAL(12, 2)))
+    ELSE ROUND(CAST(SUBSTRING_INDEX(REPLACE(heat, ' ', ''), '热', 1) AS DECIMAL(12, 2)) / 10000)
+END
+WHERE heat_w IS NULL AND heat REGEXP '^[0-9.]+ ?(万|亿)? ?热度$';
+"""
+        count = self.query(sql, op=lambda cur: cur.rowcount)
+        logger.info(f"Migrate: filled heat_w of {count} record(s)")
+
+    def create_views(self):
+        """
+        Create `record_full`, which reads like `record` with deduplicated texts restored from `content`
+
+        """
+        columns = ", ".join(
+            f"COALESCE(r.`{c}`, CONVERT(UNCOMPRESS(c_{c}.body) USING utf8mb4)) AS `{c}`" if c in CONTENT_COLUMNS
+            else f"r.`{c}`"
+            for c in ("id",) + RECORD_COLUMNS if not c.endswith("_hash")
+        )
+        joins = " ".join(f"LEFT JOIN content c_{c} ON c_{c}.hash = r.{c}_hash" for c in CONTENT_COLUMNS)
+        self.query(f"CREATE OR REPLACE VIEW record_full AS SELECT {columns} FROM record r {joins};")
+
+    def begin_crawl(self, begin_time: float) -> int:
+        """
+        Insert a crawl without ending time
+
+        :param begin_time: the time marked when crawl begin
+        :return: Crawl ID
+        """
+        return self.query("INSERT INTO crawl (begin) VALUES(%s);", begin_time, lambda x: x.lastrowid)
+
+    def write_crawls(self, crawls: list) -> int:
+        """
+        Write finished crawls in one transaction, so a partially written crawl is never visible
+
+        :param crawls: list of (crawl, record rows built by `make_row`), crawl being a dict of its `id`,
+            `begin` (None if the row exists from `begin_crawl`), `end` and optional title `revisions`;
+            spooled crawls have a `spool_key` instead of an `id`
+        :return: number of texts added to `content`
+        """
+        new_contents = set()
+        with self.transaction() as cur:
+            for crawl, rows in crawls:
+                new_contents |= self.store_crawl(
+                    cur, crawl.get("id"), crawl["end"], rows, crawl["begin"], crawl.get("revisions", ()),
+                    crawl.get("spool_key"))
+        self.known_contents |= new_contents
+        return len(new_contents)
+
+    def store_crawl(self, cur, crawl_id: int, end_time: float, rows: list, begin_time: float = None,
+                    revisions=(), spool_key: int = None) -> set:
+        """
+        Write a crawl within an open transaction: its records, title revisions, rollups and ending time
+
+        A crawl that already has an ending time is skipped, so writing the same crawl again is harmless.
+        A spooled crawl is known by its `spool_key` only: its crawl row is created here and takes the next
+        AUTO_INCREMENT ID, which replaces the spool key in its records and revisions.
+
+        :param cur: cursor of an open transaction
+        :param crawl_id: Crawl ID, None with `spool_key`
+        :param end_time: the time marked when crawl ends
+        :param rows: record rows built by `make_row`
+        :param begin_time: if given, the crawl row is created too
+        :param revisions: rows of `title_revision` from `TitleTracker.observe`
+        :param spool_key: key of the crawl in the spool, see `ZhihuCrawler.begin_crawl`
+        :return: hashes of the texts added to `content`
+        """
+        if spool_key is not None:
+            cur.execute("SELECT id, end FROM crawl WHERE spool_key = %s FOR UPDATE;", (spool_key,))
+        else:
+            cur.execute("SELECT id, end FROM crawl WHERE id = %s FOR UPDATE;", (crawl_id,))
+        crawl = cur.fetchone()
+        name = crawl_id if spool_key is None else f"with spool key {spool_key}"
+        if crawl is not None and crawl["end"] is not None:
+            logger.warning(f"Crawl {name} was already written, skipped")
+            return set()
+        if crawl is None:
+            if begin_time is None:
+                raise ValueError(f"Crawl {name} does not exist")
+            cur.execute("INSERT INTO crawl (id, begin, spool_key) VALUES (%s, %s, %s);", (crawl_id, begin_time, spool_key))
+            crawl_id = cur.lastrowid
+        else:
+            crawl_id = crawl["id"]
+        if spool_key is not None:
+            rows = [dict(row, crawl_id=crawl_id) for row in rows]
+            revisions = [dict(revision, crawl_id=crawl_id) for revision in revisions]
+        new_contents = self.insert_records(cur, rows)
+        if revisions:
+            cur.executemany(INSERT_REVISION_SQL, revisions)
+        self.update_rollups(cur, rows, end_time)
+        cur.execute("UPDATE crawl SET end = %s WHERE id = %s;", (end_time, crawl_id))
+        return new_contents
+
+    def update_rollups(self, cur, rows: list, at: float, tables=ROLLUP_TABLES):
+        """
+        Fold the records of one crawl into the hourly and daily rollups
+
+        :param cur: cursor of an open transaction
+        :param rows: record rows of the crawl
+        :param at: time of the crawl, which decides its buckets
+        :param tables: rollup tables to update, all by default
+        """
+        offset = self.config.get("rollup_utc_offset", 28800)
+        columns = ["qid", "bucket", "appearances", "last_at"] + \
+            [f"{m}_{agg}" for m in ROLLUP_METRICS for agg in ("min", "max", "last")]
+        updates = ["appearances = appearances + VALUES(appearances)"]
+        for m in ROLLUP_METRICS:
+            updates += [
+                f"{m}_min = LEAST(COALESCE({m}_min, VALUES({m}_min)), COALESCE(VALUES({m}_min), {m}_min))",
+                f"{m}_max = GREATEST(COALESCE({m}_max, VALUES({m}_max)), COALESCE(VALUES({m}_max), {m}_max))",
+                f"{m}_last = IF(VALUES(last_at) >= last_at, COALESCE(VALUES({m}_last), {m}_last), {m}_last)",
+            ]
+        updates.append("last_at = GREATEST(last_at, VALUES(last_at))")  # Last, as the updates above compare with it
+
+        for table in tables:
+            width = ROLLUP_TABLES[table]
+            bucket = int((at + offset) // width * width - offset)
+            values = [
+                (row["qid"], bucket, 1, at, *(row[m] for m in ROLLUP_METRICS for _ in range(3)))
+                for row in rows if row["qid"]
+            ]
+            if values:
+                cur.executemany(
+                    f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) "
+                    f"ON DUPLICATE KEY UPDATE {', '.join(updates)}",
+                    values
+                )
+
+    def insert_records(self, cur, rows: list) -> set:
+        """
+        Insert record rows in chunks of `batch_size`
+
+        With `dedup_content`, the LONGTEXT columns are replaced by their hashes and only texts not
+        yet stored are added to `content`. The caller adds the returned hashes to `known_contents`
+        once the transaction is committed.
+
+        :param cur: cursor of an open transaction
+        :param rows: record rows built by `make_row`
+        :return: hashes of the texts added to `content`
+        """
+        chunk = self.config.get("batch_size", 500)
+        new_contents = {}
+        if self.config.get("dedup_content", False):
+            for row in rows:
+                for column in CONTENT_COLUMNS:
+                    text = row[column]
+                    if text is None:
+                        continue
+                    digest = content_hash(text)
+                    row[f"{column}_hash"], row[column] = digest, None
+                    if digest not in self.known_contents:
+                        new_contents[digest] = text
+            contents = [(digest, compress_content(text), len(text)) for digest, text in new_contents.items()]
+            for i in range(0, len(contents), chunk):
+                cur.executemany("INSERT IGNORE INTO content (hash, body, length) VALUES (%s, %s, %s)", contents[i:i + chunk])
+        for i in range(0, len(rows), chunk):
+            cur.executemany(self.insert_record_sql(), rows[i:i + chunk])
+        return set(new_contents)
+
+    def get_content(self, hashes) -> dict:
+        """
+        Read deduplicated texts back
+
+        :param hashes: iterable of content hashes
+        :return: dict of hash -> original text
+        """
+        hashes = list(set(hashes))
+        if not hashes:
+            return {}
+        rows = self.query(
+            f"SELECT hash, body FROM content WHERE hash IN ({', '.join(['%s'] * len(hashes))});",
+            hashes, lambda cur: cur.fetchall()
+        )
+        return {row["hash"]: decompress_content(row["body"]) for row in rows}
+
+    @staticmethod
+    def insert_record_sql() -> str:
+        """
+        The multi-row friendly INSERT statement of `record`, taking rows from `make_row`
+
+        """
+        columns = ", ".join(f"`{c}`" for c in RECORD_COLUMNS)
+        values = ", ".join(f"%({c})s" for c in RECORD_COLUMNS)
+        return f"INSERT INTO record ({columns}) VALUES ({values})"
+
+    def close(self):
+        self.pool.close()
+
+
+def sqlite_placeholders(sql: str) -> str:
+    """
+    Rewrite pymysql placeholders for sqlite3: `%s` to `?`, `%(name)s` to `:name` and `%%` to `%`
+
+    :param sql: SQL with pymysql placeholders
+    :return: SQL with sqlite3 placeholders
+    """
+    return re.sub(r"%(?:\((\w+)\))?s|%%", lambda m: "%" if m.group(0) == "%%" else f":{m.group(1)}" if m.group(1) else "?",
+                  sql)
+
+
+class SQLiteCursor:
+    """
+    A sqlite3 cursor taking the placeholders of pymysql, so statements written for `MySQLStorage.transaction` can be
+    reused. As with pymysql, `execute` and `executemany` return the number of affected rows
+
+    :param cur: the sqlite3 cursor to wrap
+    """
+
+    def __init__(self, cur: sqlite3.Cursor):
+        self.cur = cur
+
+    def execute(self, sql, args=None) -> int:
+        if args is None:
+            return self.cur.execute(sql).rowcount
+        return self.cur.execute(sqlite_placeholders(sql), args).rowcount
+
+    def executemany(self, sql, args) -> int:
+        return self.cur.executemany(sqlite_placeholders(sql), args).rowcount
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    @property
+    def lastrowid(self):
+        return self.cur.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+
+class SQLiteStorage:
+    """
+    Crawls stored in an embedded SQLite database, for single-node deployments without a MySQL server
+
+    Tuned for ingest: the journal is a write-ahead log with `synchronous = NORMAL`, so a commit appends to the log
+    without waiting for a checkpoint, each `write_crawls` is one transaction, and records go through one statement
+    that sqlite3 keeps prepared. Only `crawl` and `record` are kept, with their texts inline; there are no rollups.
+
+    :param path: database file, or ":memory:"
+    :param config: the `config` section of the settings
+    """
+    INSERT_RECORD = f"INSERT INTO record ({', '.join(RECORD_COLUMNS)}) VALUES ({', '.join(f'%({c})s' for c in RECORD_COLUMNS)})"
+
+    def __init__(self, path: str, config: dict):
+        self.config = config
+        self.lock = threading.RLock()  # One connection, shared by the crawling and draining threads
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        self.conn.row_factory = lambda cur, row: {d[0]: v for d, v in zip(cur.description, row)}
+        for pragma in ("journal_mode = WAL", "synchronous = NORMAL", "temp_store = MEMORY", "cache_size = -65536"):
+            self.conn.execute(f"PRAGMA {pragma};")
+        self.known_contents = set()  # Nothing is deduplicated, kept for the common interface
+
+    @timed("query")
+    def query(self, sql, args=None, op=None):
+        """
+        Execute an SQL query. Placeholders are those of pymysql, see `sqlite_placeholders`
+
+        :param sql: the SQL query to execute
+        :param args: the arguments in the query
+        :param op: the operation to cursor after query
+        :return: op(cur)
+        """
+        if args is not None and not (isinstance(args, tuple) or isinstance(args, list)):
+            args = (args,)
+        with self.lock:
+            try:
+                cur = self.conn.execute(sql) if args is None else self.conn.execute(sqlite_placeholders(sql), args)
+            except Exception:
+                logger.error("Exception @ " + sql)
+                raise
+            if op is not None:
+                return op(cur)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run several statements and commit them together
+
+        Nothing is committed if the `with` block raises. Placeholders are those of pymysql, as for
+        `MySQLStorage.transaction`, but statements using MySQL-only syntax still fail here.
+
+        :return: a `SQLiteCursor` of the transaction
+        """
+        with self.lock:
+            cur = SQLiteCursor(self.conn.cursor())
+            cur.execute("BEGIN IMMEDIATE;")
+            try:
+                yield cur
+            except BaseException:
+                cur.execute("ROLLBACK;")
+                raise
+            cur.execute("COMMIT;")
+
+    def create_table(self):
+        """
+        Create tables to store the hot question records and crawl records, with the indexes of the MySQL storage
+
+        """
+        indexes = "".join(
+            f"CREATE {'UNIQUE ' if kind.startswith('UNIQUE') else ''}INDEX IF NOT EXISTS `{name}` ON record {columns};\n"
+            for name, (kind, columns) in MySQLStorage.RECORD_INDEXES.items()
+        )
+        with self.lock:
+            self.conn.executescript(f"""
+CREATE TABLE IF NOT EXISTS crawl (
+    id INTEGER PRIMARY KEY,
+    begin REAL NOT NULL,
+    end REAL,
+    spool_key INTEGER
+);
+CREATE TABLE IF NOT EXISTS record (
+    id INTEGER PRIMARY KEY,
+    qid INTEGER NOT NULL,
+    crawl_id INTEGER NOT NULL REFERENCES crawl (id),
+    hit_at REAL,
+    ranking INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    heat TEXT NOT NULL,
+    heat_w INTEGER,
+    created INTEGER,
+    visitCount INTEGER,
+    followerCount INTEGER,
+    answerCount INTEGER,
+    excerpt TEXT,
+    raw TEXT,
+    excerpt_hash TEXT,
+    raw_hash TEXT,
+    url TEXT
+);
+CREATE TABLE IF NOT EXISTS title_revision (
+    id INTEGER PRIMARY KEY,
+    qid INTEGER NOT NULL,
+    crawl_id INTEGER NOT NULL,
+    at REAL NOT NULL,
+    old_title TEXT,
+    title TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS title_revision_QuestionTime ON title_revision (qid, at);
+CREATE INDEX IF NOT EXISTS title_revision_Time ON title_revision (at);
+{indexes}""")
+            if "spool_key" not in {row["name"] for row in self.conn.execute("PRAGMA table_info(crawl);")}:
+                self.conn.execute("ALTER TABLE crawl ADD COLUMN spool_key INTEGER;")
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS crawl_SpoolKey ON crawl (spool_key);")
+            if self.conn.execute("SELECT 1 FROM title_revision LIMIT 1;").fetchone() is None:
+                self.conn.execute(BACKFILL_REVISIONS_SQL)
+
+    def begin_crawl(self, begin_time: float) -> int:
+        """
+        Insert a crawl without ending time
+
+        :param begin_time: the time marked when crawl begin
+        :return: Crawl ID
+        """
+        return self.query("INSERT INTO crawl (begin) VALUES (%s);", begin_time, lambda cur: cur.lastrowid)
+
+    def get_content(self, hashes) -> dict:
+        """
+        :return: an empty dict, texts are kept inline in `record`
+        """
+        return {}
+
+    def write_crawls(self, crawls: list) -> int:
+        """
+        Write finished crawls in one transaction. Crawls that already have an ending time are skipped
+
+        :param crawls: list of (crawl, record rows), as for `MySQLStorage.write_crawls`
+        :return: 0, texts are not deduplicated
+        """
+        with self.transaction() as cur:
+            for crawl, rows in crawls:
+                crawl_id, spool_key, revisions = crawl.get("id"), crawl.get("spool_key"), crawl.get("revisions", ())
+                if spool_key is not None:
+                    cur.execute("SELECT id, end FROM crawl WHERE spool_key = %s;", (spool_key,))
+                else:
+                    cur.execute("SELECT id, end FROM crawl WHERE id = %s;", (crawl_id,))
+                existing = cur.fetchone()
+                name = crawl_id if spool_key is None else f"with spool key {spool_key}"
+                if existing is not None and existing["end"] is not None:
+                    logger.warning(f"Crawl {name} was already written, skipped")
+                    continue
+                if existing is None:
+                    if crawl["begin"] is None:
+                        raise ValueError(f"Crawl {name} does not exist")
+                    cur.execute("INSERT INTO crawl (id, begin, spool_key) VALUES (%s, %s, %s);",
+                                (crawl_id, crawl["begin"], spool_key))
+                    crawl_id = cur.lastrowid
+                else:
+                    crawl_id = existing["id"]
+                if spool_key is not None:  # As in `MySQLStorage.store_crawl`
+                    rows = [dict(row, crawl_id=crawl_id) for row in rows]
+                    revisions = [dict(revision, crawl_id=crawl_id) for revision in revisions]
+                cur.executemany(self.INSERT_RECORD, rows)
+                cur.executemany(INSERT_REVISION_SQL, revisions)
+                cur.execute("UPDATE crawl SET end = %s WHERE id = %s;", (crawl["end"], crawl_id))
+        return 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "zhihu.json")
+
+
+class ZhihuCrawler:
+    INDEX_SAVE_INTERVAL = 3600  # Seconds between saves of the search index snapshot while watching
+
+    def __init__(self, settings: dict = None):
+        """
+        :param settings: the settings to use instead of loading `zhihu.json`
+        """
+        if settings is None:
+            with open(SETTINGS_PATH, "r", encoding="utf8") as f:
+                settings = json.load(f)  # Load settings
+        self.settings = settings
+        logger.info("Settings loaded")
+        if self.settings["config"].get("storage", "mysql") == "sqlite":
+            self.storage = SQLiteStorage(self.config_path("sqlite_path", "zhihu.db"), self.settings["config"])
+        else:
+            self.storage = MySQLStorage(self.settings["mysql"], self.settings["config"])
+        self.http = HttpClient(self.settings["headers"], self.settings["config"])
+        self.batch = {}  # Crawl ID -> record rows waiting for `end_crawl`
+        self.batch_lock = threading.Lock()
+        metrics.gauge("zhihu_detail_cache_entries", "Question details cached",
+                      lambda: {(): len(self.cache.entries)})
+        self.begins = {}  # Crawl ID -> begin time, for crawls going to the spool
+        self.spool = None
+        if self.config_path("spool_dir"):
+            self.spool = Spool(self.config_path("spool_dir"))
+            metrics.gauge("zhihu_spool_depth", "Crawls and bytes in the spool not yet written to the database",
+                          lambda: {(("unit", k),): v for k, v in self.spool.stats().items() if k != "lag"})
+            metrics.gauge("zhihu_spool_lag_seconds", "Age of the oldest crawl in the spool",
+                          lambda: {(): self.spool.stats()["lag"]})
+        self.window = RecentWindow(self.settings["config"].get("window_crawls", 12))
+        self.titles = TitleTracker()
+        self.index = SearchIndex()
+        self.index_saved_at = 0  # When the search index snapshot was last saved
+        self.downsampled_at = 0  # When `downsample` last ran
+        self.downsampled_until = None  # Crawls before this time are downsampled
+        self.cache = DetailCache(
+            capacity=self.settings["config"].get("detail_cache_size", 2000),
+            ttl=self.settings["config"].get("detail_cache_ttl", 21600)
+        )
+
+
+    def sleep(self, sleep_key, delta=0):
+        """
+        Execute sleeping for a time configured in the settings
+
+        :param sleep_key: the sleep time label
+        :param delta: added to the sleep time
+        :return:
+        """
+        _t = self.settings["config"][sleep_key] + delta
+        logger.info(f"Sleep {_t} second(s)")
+        metrics.observe("zhihu_stage_seconds", max(_t, 0), stage=f"sleep_{sleep_key}")
+        time.sleep(max(_t, 0))
+
+    def watch(self, top=None):
+        """
+        The crawling flow
+
+        Full crawls run on a grid of `interval_between_board` seconds, and with `board_interval` set, board-only
+        snapshots run on their own finer grid in between; when both are due, the full crawl covers the snapshot.
+        Each crawl has until `crawl_deadline` of its interval to fetch details. Ticks passed during an overrunning
+        crawl are skipped.
+
+        :param top: only look at the first `top` entries in the board. It can be used when debugging
+        :return:
+        """
+        config = self.settings["config"]
+        if self.spool is None:
+            self.prepare()
+        else:
+            try:
+                self.prepare()
+                prepared = True
+            except Exception as e:  # Crawl into the spool meanwhile, the drainer prepares once the database is back
+                logger.exception(f"Database unavailable at startup, crawling into the spool: {e}")
+                prepared = False
+            threading.Thread(target=self.drain_spool, args=(prepared,), name="spool-drainer", daemon=True).start()
+        if config.get("metrics_port"):
+            metrics.serve(config["metrics_port"])
+        crawls = Schedule("crawl", config["interval_between_board"])
+        schedules = [crawls]
+        if config.get("board_interval"):
+            schedules.append(Schedule("board", config["board_interval"]))
+        while True:
+            tick = min(schedule.next for schedule in schedules)
+            due = [schedule for schedule in schedules if schedule.next - tick < 1e-6]
+            schedule = crawls if crawls in due else due[0]
+            schedule.wait()
+            self.crawl_once(top, deadline=tick + schedule.interval * config.get("crawl_deadline", 0.9),
+                            with_details=schedule is crawls)
+            for schedule in due:
+                schedule.advance()
+            now = time.time()
+            for schedule in schedules:
+                schedule.catch_up(now)
+
+    def crawl_once(self, top=None, deadline=None, with_details=True):
+        """
+        Crawl the board and the details of its questions once
+
+        Without details, questions are recorded with their cached details, if any, and nothing is fetched
+        but the board. With `profile_dir` set, the crawl is profiled by cProfile and dumped to `<profile_dir>/crawl-<Crawl ID>.prof`.
+        Only the calling thread is profiled; work done by the fetching threads shows up as waiting.
+
+        :param top: only look at the first `top` entries in the board
+        :param deadline: time by which the details must be fetched, see `fetch_details`
+        :param with_details: whether to fetch the details of the questions
+        :return: Crawl ID, or None if the crawl could not begin
+        """
+        profiler = None
+        if self.config_path("profile_dir"):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        logger.info("Begin crawling ...")
+        crawl_id = None
+        try:
+            begin_time = time.time()
+            crawl_id = self.begin_crawl(begin_time)
+
+            try:
+                board_entries = self.get_board()
+            except RuntimeError as e:
+                if isinstance(e.args[0], requests.Response):
+                    logger.exception(e.args[0].status_code, e.args[0].text)
+                raise
+            else:
+                logger.info(
+                    f"Get {len(board_entries)} items: {','.join(map(lambda x: x['title'][:20], board_entries))}")
+            if top:
+                board_entries = board_entries[:top]
+
+            # Process each entry in the hot list
+            if with_details:
+                details = self.fetch_details(crawl_id, board_entries, deadline=deadline)
+            else:
+                details = [self.snapshot_detail(item) for item in board_entries]
+            for idx, (item, detail) in enumerate(zip(board_entries, details)):
+                try:
+                    self.add_entry(crawl_id, idx, item, detail)
+                except Exception as e:
+                    logger.exception(f"Exception when adding entry {e}")
+            self.end_crawl(crawl_id)
+            movers = self.window.movers(k=3)
+            if movers:
+                logger.info("Rising fastest: " + ", ".join(f"{qid} {v:+.0f} 万/h" for qid, v in movers))
+            self.downsample()
+        except Exception as e:
+            logger.exception(f"Crawl {crawl_id} encountered an exception {e}. This crawl stopped.")
+            with self.batch_lock:
+                self.batch.pop(crawl_id, None)
+                self.begins.pop(crawl_id, None)
+        if profiler is not None:
+            profiler.disable()
+            profile_dir = self.config_path("profile_dir")
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir, f"crawl-{crawl_id}.prof"))
+        return crawl_id
+
+    def fetch_details(self, crawl_id, board_entries, rankings=None, deadline=None) -> list:
+        """
+        Fetch the details of all entries in the board
+
+        With `workers` > 1 in the config, details are fetched by a thread pool and the request rate
+        is bounded by a token bucket (`requests_per_second`, `burst`) instead of sleeping between questions.
+        Without `requests_per_second`, the rate is the one of sleeping, one question per `interval_between_question`.
+
+        Past the deadline no more fetches are started and the entries left get empty details. Fetches already
+        running are not waited for; they still fill the detail cache for the next crawl.
+
+        :param crawl_id: Crawl ID
+        :param board_entries: entries returned by `get_board`
+        :param rankings: rankings of the entries in the board, if they are not the whole board in order
+        :param deadline: time by which the details must be fetched, or None to wait for all of them
+        :return: details in the same order as `board_entries`
+        """
+        config = self.settings["config"]
+        workers = config.get("workers", 1)
+        if rankings is None:
+            rankings = range(len(board_entries))
+        self.cache.reset_stats()
+        if workers <= 1:
+            details = []
+            for idx, item in zip(rankings, board_entries):
+                detail = self.cached_detail(idx, item)
+                if detail is None and (deadline is None or time.time() < deadline):
+                    self.sleep("interval_between_question")
+                    detail = self.fetch_detail(crawl_id, idx, item)
+                details.append(detail)
+        else:
+            interval = config.get("interval_between_question", 0)
+            rate = config.get("requests_per_second") or (1 / interval if interval > 0 else float("inf"))
+            bucket = TokenBucket(rate, config.get("burst", 1))
+
+            def task(idx, item):
+                detail = self.cached_detail(idx, item)
+                if detail is None:
+                    bucket.acquire()
+                    if deadline is not None and time.time() >= deadline:
+                        return None
+                    detail = self.fetch_detail(crawl_id, idx, item)
+                return detail
+
+            pool = ThreadPoolExecutor(max_workers=workers)
+            futures = [pool.submit(task, idx, item) for idx, item in zip(rankings, board_entries)]
+            done, _ = wait(futures, timeout=None if deadline is None else max(deadline - time.time(), 0))
+            pool.shutdown(wait=False, cancel_futures=True)
+            details = [future.result() if future in done else None for future in futures]
+
+        deferred = sum(detail is None for detail in details)
+        if deferred:
+            logger.warning(f"Crawl {crawl_id} reached its deadline, {deferred} detail(s) deferred")
+            metrics.inc("zhihu_details_deferred_total", deferred)
+            details = [self.empty_detail() if detail is None else detail for detail in details]
+
+        cache = self.cache
+        total = cache.hits + cache.misses
+        if total:
+            logger.info(f"Detail cache: {cache.hits}/{total} hits ({cache.hits / total:.0%}), "
+                        f"{cache.bytes_saved / 1024:.0f} KB saved, {len(cache.entries)} cached")
+        return details
+
+    def cached_detail(self, idx, item):
+        """
+        Decide by the refresh policy whether a cached detail can be used instead of fetching
+
+        A question is fetched again if it ranks within `refresh_top`, if its heat moved by more than
+        `refresh_heat_change` (relative) since the last fetch, or if its entry is older than
+        `refresh_interval` times one plus the number of refreshes in a row that found it unchanged.
+
+        :param idx: Ranking in the board
+        :param item: dict, info from the board
+        :return: the cached detail from `reused_detail`, or None if it should be fetched
+        """
+        config = self.settings["config"]
+        entry = None
+        if item["qid"] and self.cache.capacity > 0 and idx >= config.get("refresh_top", 10):
+            entry = self.cache.get(item["qid"])
+        if entry is not None:
+            heat = parse_heat(item["heat"])
+            if entry["heat"] and heat is not None and \
+                    abs(heat - entry["heat"]) / entry["heat"] > config.get("refresh_heat_change", 0.2):
+                entry = None
+            elif time.time() - entry["fetched_at"] > config.get("refresh_interval", 1200) * (entry["stable"] + 1):
+                entry = None
+        self.cache.record(entry)
+        return None if entry is None else self.reused_detail(entry)
+
+    def snapshot_detail(self, item) -> dict:
+        """
+        The detail of a board entry in a board-only crawl: the cached one regardless of its age, or an empty one
+
+        :param item: dict, info from the board
+        :return: the detail dict
+        """
+        entry = self.cache.get(item["qid"]) if item["qid"] and self.cache.capacity > 0 else None
+        return self.empty_detail() if entry is None else self.reused_detail(entry)
+
+    @staticmethod
+    def reused_detail(entry) -> dict:
+        """
+        A copy of a cached detail for a new record, without the counters and `hit_at` of the earlier fetch
+
+        Those are left None so the rollups and the recent window do not take old counts for new ones.
+
+        :param entry: entry of `DetailCache`
+        :return: the detail dict
+        """
+        return dict(entry["detail"], visitCount=None, followerCount=None, answerCount=None, hit_at=None)
+
+    @staticmethod
+    def empty_detail() -> dict:
+        """
+        :return: the detail of a question that could not be fetched, all fields None
+        """
+        return {
+            "created": None,
+            "visitCount": None,
+            "followerCount": None,
+            "answerCount": None,
+            "raw": None,
+            "hit_at": None
+        }
+
+    def fetch_detail(self, crawl_id, idx, item) -> dict:
+        """
+        Fetch the detail of a board entry, logging instead of raising on failure
+
+        :param crawl_id: Crawl ID
+        :param idx: Ranking in the board
+        :param item: dict, info from the board
+        :return: the detail dict, with all fields None if it failed
+        """
+        detail = self.empty_detail()
+        if item["qid"] is None:
+            logger.warning(f"Unparsed URL @ {item['url']} ranking {idx} in crawl {crawl_id}.")
+        else:
+            try:
+                detail = self.get_question(item["qid"])
+            except Exception as e:
+                if len(e.args) > 0 and isinstance(e.args[0], requests.Response):
+                    logger.exception(f"{e}; {e.args[0].status_code}; {e.args[0].text}")
+                else:
+                    logger.exception(f"{str(e)}")
+            else:
+                logger.info(f"Get question detail for {item['title']}: raw detail length {len(detail['raw']) if detail['raw'] else 0}")
+                if self.cache.capacity > 0:
+                    self.cache.put(item["qid"], detail, parse_heat(item["heat"]), detail.get("bytes", 0))
+        return detail
+
+    def coordinate(self, top=None):
+        """
+        The crawling flow of the coordinator: fetch the board and leave its questions to `work` processes
+
+        :param top: only look at the first `top` entries in the board
+        """
+        self.create_table()
+        self.load_titles()
+        if self.settings["config"].get("metrics_port"):
+            metrics.serve(self.settings["config"]["metrics_port"])
+        crawls = Schedule("crawl", self.settings["config"]["interval_between_board"])
+        while True:
+            crawls.wait()
+            try:
+                self.coordinate_once(top)
+            except Exception as e:
+                logger.exception(f"Coordinator encountered an exception {e}. This crawl stopped.")
+            crawls.advance()
+            crawls.catch_up(time.time())
+
+    def coordinate_once(self, top=None):
+        """
+        Begin a crawl and enqueue one job per board entry in `crawl_job`, then wait for the workers
+
+        The crawl is ended once all its jobs are done, or after `job_timeout` seconds without the jobs left over.
+        Its jobs are then deleted, so a worker finishing late writes nothing.
+
+        :param top: only look at the first `top` entries in the board
+        :return: Crawl ID
+        """
+        config = self.settings["config"]
+        begin_time = time.time()
+        board_entries = self.get_board()
+        if top:
+            board_entries = board_entries[:top]
+        revisions = []
+        try:
+            with self.storage.transaction() as cur:
+                cur.execute("INSERT INTO crawl (begin) VALUES (%s);", (begin_time,))
+                crawl_id = cur.lastrowid
+                cur.executemany(
+                    "INSERT INTO crawl_job (crawl_id, ranking, board) VALUES (%s, %s, %s);",
+                    [(crawl_id, idx, json.dumps(item, ensure_ascii=False)) for idx, item in enumerate(board_entries)]
+                )
+                revisions = self.titles.observe(board_entries, crawl_id, begin_time)
+                if revisions:
+                    cur.executemany(INSERT_REVISION_SQL, revisions)
+        except Exception:
+            self.titles.revert(revisions)
+            raise
+        self.titles.publish(revisions)
+        logger.info(f"Crawl {crawl_id}: {len(board_entries)} job(s) queued")
+
+        deadline = begin_time + config.get("job_timeout", 300)
+        while True:
+            pending = self.storage.query(
+                "SELECT COUNT(*) AS n FROM crawl_job WHERE crawl_id = %s AND done = 0;",
+                crawl_id, lambda cur: cur.fetchone()["n"]
+            )
+            if not pending or time.time() > deadline:
+                break
+            time.sleep(1)
+        if pending:
+            logger.warning(f"Crawl {crawl_id}: {pending} job(s) not done in time, ended without them")
+
+        end_time = time.time()
+        with self.storage.transaction() as cur:
+            cur.execute("DELETE FROM crawl_job WHERE crawl_id = %s;", (crawl_id,))  # Waits for workers writing
+            cur.execute("UPDATE crawl SET end = %s WHERE id = %s AND end IS NULL;", (end_time, crawl_id))
+            if cur.rowcount:
+                cur.execute(f"SELECT qid, {', '.join(ROLLUP_METRICS)} FROM record WHERE crawl_id = %s;", (crawl_id,))
+                self.storage.update_rollups(cur, cur.fetchall(), end_time)
+        self.downsample()
+        return crawl_id
+
+    def work(self):
+        """
+        The crawling flow of a worker: lease jobs from `crawl_job`, fetch their details and write the records
+
+        A lease lasts `job_lease` seconds; jobs of a worker that died are leased again by others once it expires.
+        Records are only written for jobs still held by the lease, in the same transaction that marks them done,
+        so each board entry of a crawl is written once.
+        """
+        config = self.settings["config"]
+        worker = config.get("worker_id") or f"{socket.gethostname()}-{os.getpid()}"
+        logger.info(f"Worker {worker} started")
+        while True:
+            try:
+                lease, jobs = self.lease_jobs(worker)
+                if not jobs:
+                    time.sleep(1)
+                    continue
+                board_entries = [json.loads(job["board"]) for job in jobs]
+                details = self.fetch_details(
+                    jobs[0]["crawl_id"], board_entries, [job["ranking"] for job in jobs])
+                rows = [
+                    self.make_row(job["crawl_id"], job["ranking"], item, detail)
+                    for job, item, detail in zip(jobs, board_entries, details)
+                ]
+                self.finish_jobs(lease, rows)
+            except Exception as e:
+                logger.exception(f"Worker {worker} encountered an exception {e}")
+                time.sleep(1)
+
+    def lease_jobs(self, worker: str) -> (str, list):
+        """
+        Lease up to `job_batch` pending jobs whose lease is free or expired
+
+        :param worker: name of the worker, kept for inspection
+        :return: (lease token, the jobs)
+        """
+        config = self.settings["config"]
+        lease = uuid.uuid4().hex
+        now = time.time()
+        with self.storage.transaction() as cur:
+            cur.execute(
+                "UPDATE crawl_job SET lease = %s, lease_until = %s, worker = %s, attempts = attempts + 1 "
+                "WHERE done = 0 AND (lease_until IS NULL OR lease_until < %s) "
+                "ORDER BY crawl_id, ranking LIMIT %s;",
+                (lease, now + config.get("job_lease", 120), worker, now, config.get("job_batch", 10))
+            )
+            if not cur.rowcount:
+                return lease, []
+            cur.execute("SELECT crawl_id, ranking, board FROM crawl_job WHERE lease = %s ORDER BY crawl_id, ranking;",
+                        (lease,))
+            return lease, cur.fetchall()
+
+    @timed("write_crawl")
+    def finish_jobs(self, lease: str, rows: list):
+        """
+        Write the records of leased jobs and mark the jobs done, skipping those no longer held by the lease
+
+        :param lease: lease token from `lease_jobs`
+        :param rows: record rows of the jobs
+        """
+        with self.storage.transaction() as cur:
+            cur.execute("SELECT crawl_id, ranking FROM crawl_job WHERE lease = %s AND done = 0 FOR UPDATE;", (lease,))
+            held = {(job["crawl_id"], job["ranking"]) for job in cur.fetchall()}
+            leased = len(rows)
+            rows = [row for row in rows if (row["crawl_id"], row["ranking"]) in held]
+            new_contents = self.storage.insert_records(cur, rows)
+            cur.execute("UPDATE crawl_job SET done = 1 WHERE lease = %s;", (lease,))
+        self.storage.known_contents |= new_contents
+        # Jobs whose lease expired were re-leased to another worker or deleted with their crawl
+        logger.info(f"Lease {lease}: {len(rows)} record(s) written, {leased - len(held)} job(s) lost")
+
+    def config_path(self, key, default=""):
+        """
+        A file or directory of the config, relative to `zhihu.json` unless absolute
+
+        :param key: e.g. "spool_dir"
+        :param default: the value if `key` is not set
+        :return: the path, or the value itself if empty or ":memory:"
+        """
+        path = self.settings["config"].get(key, default)
+        if not path or path == ":memory:":
+            return path
+        return os.path.join(os.path.dirname(SETTINGS_PATH), path)
+
+    def create_table(self):
+        """
+        Create tables to store the hot question records and crawl records
+
+        """
+        self.storage.create_table()
+
+    def prepare(self, window=True):
+        """
+        Create the tables and load what is kept in memory from the database: the recent window, titles and search index
+
+        :param window: whether to warm the recent window, which is only right while it is empty
+        """
+        self.create_table()
+        if window:
+            self.warm_window()
+        self.load_titles()
+        self.warm_index()
+
+    def warm_window(self):
+        """
+        Fill the recent window from the last finished crawls in the database, e.g. after a restart
+
+        """
+        crawls = self.storage.query(
+            "SELECT id, end FROM crawl WHERE end IS NOT NULL ORDER BY end DESC LIMIT %s;", self.window.size,
+            lambda cur: cur.fetchall()
+        )
+        if not crawls:
+            return
+        rows = self.storage.query(
+            f"SELECT crawl_id, qid, {', '.join(WINDOW_METRICS)} FROM record "
+            f"WHERE crawl_id IN ({', '.join(['%s'] * len(crawls))});",
+            [crawl["id"] for crawl in crawls], lambda cur: cur.fetchall()
+        )
+        for crawl in reversed(crawls):
+            self.window.add(crawl["end"], [row for row in rows if row["crawl_id"] == crawl["id"]])
+        logger.info(f"Recent window warmed from {len(crawls)} crawl(s), {len(self.window.questions)} question(s)")
+
+    def load_titles(self):
+        """
+        Load the current title of each question from `title_revision` into the title tracker
+
+        """
+        rows = self.storage.query("SELECT qid, title FROM title_revision ORDER BY at, id;", op=lambda cur: cur.fetchall())
+        self.titles.load({row["qid"]: row["title"] for row in rows})
+        logger.info(f"Titles of {len(self.titles.titles)} question(s) loaded")
+
+    def title_revisions(self, qid=None, since=None) -> list:
+        """
+        The questions retitled and when, from `title_revision`
+
+        :param qid: only this question
+        :param since: only revisions at or after this time
+        :return: list of dicts with `qid`, `crawl_id`, `at`, `old_title` and `title`, oldest first
+        """
+        conditions, args = ["old_title IS NOT NULL"], []
+        if qid is not None:
+            conditions.append("qid = %s")
+            args.append(qid)
+        if since is not None:
+            conditions.append("at >= %s")
+            args.append(since)
+        return self.storage.query(
+            f"SELECT qid, crawl_id, at, old_title, title FROM title_revision WHERE {' AND '.join(conditions)} "
+            f"ORDER BY at, id;", args or None, lambda cur: cur.fetchall()
+        )
+
+    def search(self, query: str, qids=None, since=None, until=None, limit=50) -> list:
+        """
+        Find questions whose title, excerpt or detail contain the query terms, see `SearchIndex.search`
+
+        """
+        return self.index.search(query, qids, since, until, limit)
+
+    def index_crawls(self, after: float = 0, chunk: int = 200):
+        """
+        Add the finished crawls ended after some time to the search index
+
+        :param after: end time of the last crawl already indexed
+        :param chunk: crawls read per query
+        """
+        crawls = self.storage.query(
+            "SELECT id, end FROM crawl WHERE end IS NOT NULL AND end > %s ORDER BY end;", after,
+            lambda cur: cur.fetchall()
+        )
+        for i in range(0, len(crawls), chunk):
+            ends = {crawl["id"]: crawl["end"] for crawl in crawls[i:i + chunk]}
+            rows = self.storage.query(
+                f"SELECT qid, crawl_id, title, excerpt, raw, excerpt_hash, raw_hash FROM record "
+                f"WHERE crawl_id IN ({', '.join(['%s'] * len(ends))});",
+                list(ends), lambda cur: cur.fetchall()
+            )
+            missing = {row[f"{c}_hash"] for row in rows for c in CONTENT_COLUMNS} - set(self.index.texts) - {None}
+            contents = self.storage.get_content(missing) if missing else {}
+            for row in rows:
+                self.index.add(row["qid"], ends[row["crawl_id"]], row["title"], tuple(
+                    (row[f"{c}_hash"], row[c] if row[c] is not None else contents.get(row[f"{c}_hash"]))
+                    for c in CONTENT_COLUMNS
+                ))
+            self.index.indexed_until = crawls[i + len(ends) - 1]["end"]
+            logger.info(f"Search index: {i + len(ends)}/{len(crawls)} crawl(s) indexed")
+
+    def warm_index(self):
+        """
+        Load the search index snapshot at `search_index_path`, if any, and index the crawls written since
+
+        """
+        path = self.config_path("search_index_path")
+        if path and os.path.exists(path):
+            self.index.load(path)
+        self.index_crawls(self.index.indexed_until)
+        self.save_index(force=True)
+        logger.info(f"Search index: {len(self.index.documents)} question(s), {len(self.index.postings)} gram(s)")
+
+    def reindex(self):
+        """
+        Rebuild the search index from the whole database and save it to `search_index_path`
+
+        """
+        self.index = SearchIndex()
+        self.index_crawls()
+        self.save_index(force=True)
+        logger.info(f"Search index: {len(self.index.documents)} question(s), {len(self.index.postings)} gram(s)")
+
+    def save_index(self, force=False):
+        """
+        Save the search index snapshot to `search_index_path`, at most every `INDEX_SAVE_INTERVAL` seconds
+
+        :param force: save even if the last save is recent
+        """
+        path = self.config_path("search_index_path")
+        if not path or not force and time.time() - self.index_saved_at < self.INDEX_SAVE_INTERVAL:
+            return
+        self.index.save(path)
+        self.index_saved_at = time.time()
+
+    def index_written(self, texts, at: float):
+        """
+        Add a crawl to the search index once it is written to the database, and save the snapshot now and then
+
+        :param texts: (qid, title, excerpt, raw) of its records, taken before writing, which replaces texts by hashes
+        :param at: ending time of the crawl
+        """
+        for qid, title, excerpt, raw in texts:
+            self.index.add(qid, at, title, ((None, excerpt), (None, raw)))
+        self.index.indexed_until = max(self.index.indexed_until, at)
+        self.save_index()
+
+    def begin_crawl(self, begin_time) -> (int,float):
+        """
+        Mark the beginning of a crawl
+
+        With the spool on, the crawl is known by a spool key, the begin time in milliseconds, until the spool
+        is drained: only then is the crawl row written, and it takes its ID from AUTO_INCREMENT as usual.
+        :param begin_time:
+        :return: (Crawl ID, the time marked when crawl begin)
+        """
+        if self.spool is not None:
+            crawl_id = int(begin_time * 1000)
+            with self.batch_lock:
+                self.begins[crawl_id] = begin_time
+            return crawl_id
+        return self.storage.begin_crawl(begin_time)
+
+    def end_crawl(self, crawl_id: int):
+        """
+        Mark the ending time of a crawl, writing all its entries in the same transaction,
+        or appending them to the spool if it is on
+
+        :param crawl_id: Crawl ID
+        """
+        with self.batch_lock:
+            rows = self.batch.pop(crawl_id, [])
+            begin_time = self.begins.pop(crawl_id, None)
+        end_time = time.time()
+        self.window.add(end_time, rows)
+        revisions = self.titles.observe(rows, crawl_id, end_time)
+        try:
+            if self.spool is not None:
+                self.spool.append(
+                    {"spool_key": crawl_id, "begin": begin_time, "end": end_time, "revisions": revisions}, rows)
+            else:
+                texts = [(row["qid"], row["title"], row["excerpt"], row["raw"]) for row in rows]
+                self.write_crawl(crawl_id, end_time, rows, revisions)
+        except Exception:
+            self.titles.revert(revisions)  # Seen again by the next crawl
+            raise
+        self.titles.publish(revisions)
+        if self.spool is None:  # Spooled crawls are indexed once drained
+            self.index_written(texts, end_time)
+
+    @timed("write_crawl")
+    def write_crawl(self, crawl_id: int, end_time: float, rows: list, revisions=()):
+        """
+        Insert the records of a crawl and set its ending time in one transaction,
+        so a partially written crawl is never visible
+
+        :param crawl_id: Crawl ID
+        :param end_time: the time marked when crawl ends
+        :param rows: record rows built by `make_row`
+        :param revisions: title revisions of the crawl
+        """
+        new_contents = self.storage.write_crawls(
+            [({"id": crawl_id, "begin": None, "end": end_time, "revisions": list(revisions)}, rows)])
+        logger.info(f"Crawl {crawl_id} written: {len(rows)} record(s), {new_contents} new text(s)")
+
+    def drain_spool(self, prepared=True):
+        """
+        Ship spooled crawls into the database, forever. Runs on the spool's background thread
+
+        Up to `spool_drain_batch` crawls are written per transaction. The spool position is only advanced
+        after the commit, and `write_crawls` skips crawls already written, so replays after a crash are idempotent.
+
+        :param prepared: whether `prepare` succeeded at startup; if not, it is retried here before draining,
+            without the recent window, which has filled up since
+        """
+        backoff = 1
+        while not prepared:
+            time.sleep(backoff)
+            try:
+                self.prepare(window=False)
+                prepared = True
+                logger.info("Database is back, draining the spool")
+            except Exception as e:
+                backoff = min(backoff * 2, 60)
+                logger.warning(f"Database still unavailable, retry in {backoff}s: {e}")
+        backoff = 1
+        while True:
+            crawls, offset = self.spool.read(self.settings["config"].get("spool_drain_batch", 20))
+            for crawl, _ in crawls:
+                if crawl.get("spool_key") is None:  # Spooled as `id` by earlier versions
+                    crawl["spool_key"] = crawl.pop("id")
+            if not crawls:
+                self.spool.wakeup.wait(5)
+                self.spool.wakeup.clear()
+                continue
+            texts = [
+                (crawl["end"], [(row["qid"], row["title"], row["excerpt"], row["raw"]) for row in rows])
+                for crawl, rows in crawls
+            ]
+            try:
+                self.storage.write_crawls(crawls)
+            except Exception as e:
+                logger.exception(f"Spool drain failed, retry in {backoff}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+            backoff = 1
+            self.spool.commit(offset, len(crawls))
+            for end_time, crawl_texts in texts:
+                self.index_written(crawl_texts, end_time)
+            stats = self.spool.stats()
+            logger.info(f"Spool: drained {len(crawls)} crawl(s), {sum(len(rows) for _, rows in crawls)} record(s); "
+                        f"depth {stats['crawls']} crawl(s) / {stats['bytes']} bytes, lag {stats['lag']:.1f}s")
+
+    def rebuild_rollups(self):
+        """
+        Recompute the rollups from all finished crawls in `record`, e.g. after importing historic data
+
+        Once `downsample` has thinned out records, the buckets up to the last downsampled crawl only survive in the
+        rollups, so those are left as they are and only the later buckets are rebuilt.
+        """
+        storage = self.storage
+        offset = self.settings["config"].get("rollup_utc_offset", 28800)
+        boundaries = dict.fromkeys(ROLLUP_TABLES, 0)  # Rollup table -> first bucket to rebuild
+        downsampled_until = storage.get_watermark("downsampled_until")
+        if downsampled_until is not None:
+            last = storage.query(
+                "SELECT MAX(end) AS t FROM crawl WHERE begin < %s;", downsampled_until, lambda cur: cur.fetchone()["t"])
+            for table, width in ROLLUP_TABLES.items():
+                # The bucket after the one of the last downsampled crawl
+                boundaries[table] = int(((last or 0) + offset) // width * width + width - offset)
+            logger.info(f"Records before {time.ctime(downsampled_until)} are downsampled, keeping their rollups")
+        for table, boundary in boundaries.items():
+            if boundary:
+                storage.query(f"DELETE FROM {table} WHERE bucket >= %s;", boundary)
+            else:
+                storage.query(f"TRUNCATE TABLE {table};")
+        crawls = storage.query(
+            "SELECT id, end FROM crawl WHERE end IS NOT NULL AND end >= %s ORDER BY id;",
+            min(boundaries.values()), lambda cur: cur.fetchall()
+        )
+        for i, crawl in enumerate(crawls):
+            rows = storage.query(
+                f"SELECT qid, {', '.join(ROLLUP_METRICS)} FROM record WHERE crawl_id = %s;",
+                crawl["id"], lambda cur: cur.fetchall()
+            )
+            tables = [table for table, boundary in boundaries.items() if crawl["end"] >= boundary]
+            with storage.transaction() as cur:
+                storage.update_rollups(cur, rows, crawl["end"], tables)
+            if (i + 1) % 100 == 0:
+                logger.info(f"Rolled up {i + 1}/{len(crawls)} crawls")
+        logger.info(f"Rollups rebuilt from {len(crawls)} crawls")
+
+    def downsample(self):
+        """
+        Thin out raw records older than `raw_retention_days`, keeping the last record per question and hour
+
+        The rollups keep the aggregates of the deleted rows. Runs at most once an hour, one day of crawls per statement.
+        How far it got is saved as the `downsampled_until` watermark, which `rebuild_rollups` respects.
+        """
+        days = self.settings["config"].get("raw_retention_days", 0)
+        if not isinstance(self.storage, MySQLStorage):  # No rollups to keep the aggregates
+            return
+        if not days or time.time() - self.downsampled_at < 3600:
+            return
+        self.downsampled_at = time.time()
+        cutoff = time.time() - days * 86400
+        if self.downsampled_until is None:
+            self.downsampled_until = self.storage.get_watermark("downsampled_until") or self.storage.query(
+                "SELECT MIN(begin) AS t FROM crawl;", op=lambda cur: cur.fetchone()["t"]) or cutoff
+        sql = """
+DELETE r FROM record r
+JOIN crawl c ON c.id = r.crawl_id
+JOIN (
+    SELECT r2.qid, FLOOR(c2.begin / 3600) AS hour, MAX(r2.id) AS keep_id
+    FROM record r2 JOIN crawl c2 ON c2.id = r2.crawl_id
+    WHERE c2.begin >= %s AND c2.begin < %s
+    GROUP BY r2.qid, hour
+) k ON k.qid = r.qid AND k.hour = FLOOR(c.begin / 3600)
+WHERE c.begin >= %s AND c.begin < %s AND r.id <> k.keep_id;
+"""
+        deleted = 0
+        while self.downsampled_until < cutoff:
+            until = min(self.downsampled_until + 86400, cutoff)
+            with self.storage.transaction() as cur:
+                deleted += cur.execute(sql, (self.downsampled_until, until) * 2)
+                self.storage.set_watermark(cur, "downsampled_until", until)
+            self.downsampled_until = until
+        if deleted:
+            logger.info(f"Downsampled {deleted} raw record(s) older than {days} day(s)")
+
+    def make_row(self, crawl_id, idx, board, detail) -> dict:
+        """
+        Build a `record` row from a board entry and its detail
+
+        :param crawl_id: Crawl ID
+        :param idx: Ranking in the board
+        :param board: dict, info from the board
+        :param detail: dict, info from the detail page
+        :return: dict of column values
+        """
+        return {
+            "qid": board["qid"],
+            "crawl_id": crawl_id,
+            "title": board["title"],
+            "heat": board["heat"],
+            "heat_w": parse_heat(board["heat"]),
+            "created": detail["created"],
+            "visitCount": detail["visitCount"],
+            "followerCount": detail["followerCount"],
+            "answerCount": detail["answerCount"],
+            "excerpt": board["excerpt"],
+            "raw": detail["raw"],
+            "excerpt_hash": None,
+            "raw_hash": None,
+            "ranking": idx,
+            "hit_at": detail["hit_at"],
+            "url": board["url"]
+        }
+
+    def add_entry(self, crawl_id, idx, board, detail):
+        """
+        Add a question entry to the crawl. It is written to the database by `end_crawl`
+
+        :param crawl_id: Crawl ID
+        :param idx: Ranking in the board
+        :param board: dict, info from the board
+        :param detail: dict, info from the detail page
+        """
+        row = self.make_row(crawl_id, idx, board, detail)
+        with self.batch_lock:
+            self.batch.setdefault(crawl_id, []).append(row)
+
+    def backfill(self, rows, commit_every=50000) -> int:
+        """
+        Bulk insert historic `record` rows, bypassing the per-crawl path
+
+        Unique and foreign key checks are disabled for the session and rows are committed in large groups.
+
+        :param rows: iterable of dicts with the keys in `RECORD_COLUMNS`
+        :param commit_every: number of rows per transaction
+        :return: number of rows inserted
+        """
+        chunk = self.settings["config"].get("batch_size", 500)
+        total, buffer, uncommitted, new_contents = 0, [], 0, set()
+        begin_time = time.time()
+        with self.storage.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SET unique_checks = 0, foreign_key_checks = 0;")
+                try:
+                    for row in rows:
+                        buffer.append(dict(dict.fromkeys(RECORD_COLUMNS), **row))
+                        if len(buffer) >= chunk:
+                            new_contents |= self.storage.insert_records(cur, buffer)
+                            total, uncommitted, buffer = total + len(buffer), uncommitted + len(buffer), []
+                            if uncommitted >= commit_every:
+                                conn.commit()
+                                self.storage.known_contents |= new_contents
+                                uncommitted, new_contents = 0, set()
+                                logger.info(f"Backfilled {total} rows, {total / (time.time() - begin_time):.0f} rows/s")
+                    if buffer:
+                        new_contents |= self.storage.insert_records(cur, buffer)
+                        total += len(buffer)
+                    conn.commit()
+                    self.storage.known_contents |= new_contents
+                finally:
+                    cur.execute("SET unique_checks = 1, foreign_key_checks = 1;")
+        logger.info(f"Backfilled {total} rows in {time.time() - begin_time:.1f}s")
+        return total
+
+    def import_dump(self, path, database, commit_every=20):
+        """
+        Load a `mysqldump` file such as `exercise.sql` in bulk mode into its own database
+
+        A dump drops and recreates its tables, so it is never loaded into the crawler's database. `database`
+        is created on the MySQL server of the settings if needed, and brought up to the crawler's schema
+        (columns, indexes, views, title revisions) after the import.
+
+        Statements are streamed from the file and committed every `commit_every` statements, with
+        unique and foreign key checks disabled. Dumps keep each statement on lines ending with `;`.
+
+        :param path: path to the dump
+        :param database: database to import into, not the crawler's
+        :param commit_every: number of statements per transaction
+        """
+        if database == self.settings["mysql"].get("database"):
+            raise ValueError(f"Refusing to import a dump into the crawler's database {database}")
+        server = {k: v for k, v in self.settings["mysql"].items() if k != "database"}
+        with pymysql.connect(**server) as conn, conn.cursor() as cur:
+            cur.execute(f"CREATE DATABASE IF NOT EXISTS `{database}`")
+        storage = MySQLStorage(dict(server, database=database), self.settings["config"])
+        rows, statements = 0, 0
+        begin_time = time.time()
+        with storage.pool.connection() as conn, open(path, "r", encoding="utf8") as f:
+            with conn.cursor() as cur:
+                cur.execute("SET unique_checks = 0, foreign_key_checks = 0;")
+                try:
+                    statement = []
+                    for line in f:
+                        if not statement and (line.startswith("--") or not line.strip()):
+                            continue
+                        statement.append(line)
+                        if not line.rstrip().endswith(";"):
+                            continue
+                        cur.execute("".join(statement))
+                        statement = []
+                        statements += 1
+                        rows += max(cur.rowcount, 0)
+                        if statements % commit_every == 0:
+                            conn.commit()
+                            logger.info(f"Imported {rows} rows, {rows / (time.time() - begin_time):.0f} rows/s")
+                    conn.commit()
+                finally:
+                    cur.execute("SET unique_checks = 1, foreign_key_checks = 1;")
+        logger.info(f"Imported {statements} statements, {rows} rows in {time.time() - begin_time:.1f}s")
+        storage.create_table()
+        storage.close()
+
+    def export(self, out_dir, chunk_rows=50000, chunk_bytes=64 << 20):
+        """
+        Export finished crawls to Parquet files partitioned by day, streaming from a server-side cursor
+
+        Only crawls after the last exported crawl ID (kept in `<out_dir>/_export_state.json`) are exported, so
+        running it again appends new partition files. A batch holds at most `chunk_rows` rows and stops growing once its
+        texts pass `chunk_bytes`, since a record row carries its full excerpt and page.
+        Files are written as `<out_dir>/<crawl|record>/date=YYYY-MM-DD/part-<first crawl ID>.parquet`,
+        compressed with `export_compression`, and records come with their deduplicated texts restored.
+
+        :param out_dir: output directory
+        :param chunk_rows: rows fetched and written per batch
+        :param chunk_bytes: approximate size of the texts in a batch
+        """
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Exporting needs pyarrow: pip install pyarrow")
+
+        state_path = os.path.join(out_dir, "_export_state.json")
+        last = 0
+        if os.path.exists(state_path):
+            with open(state_path, "r", encoding="utf8") as f:
+                last = json.load(f)["last_crawl_id"]
+        upto = self.storage.query("SELECT MAX(id) AS id FROM crawl WHERE end IS NOT NULL;", op=lambda cur: cur.fetchone()["id"])
+        if upto is None or upto <= last:
+            logger.info("Export: nothing new")
+            return
+
+        offset = self.settings["config"].get("rollup_utc_offset", 28800)
+        compression = self.settings["config"].get("export_compression", "zstd")
+
+        def arrow_type(column):
+            if column in EXPORT_INTEGERS:
+                return pa.int64()
+            if column in EXPORT_FLOATS:
+                return pa.float64()
+            return pa.string()
+
+        def day_of(at):
+            return time.strftime("%Y-%m-%d", time.gmtime(at + offset))
+
+        def stream(name, sql, time_column, crawl_column):
+            """
+            Write the rows of `sql` to `<out_dir>/<name>`, starting a new file when the day of `time_column` changes
+
+            """
+            writer, day, total = None, None, 0
+            with self.storage.pool.connection() as conn:
+                with conn.cursor(pymysql.cursors.SSCursor) as cur:
+                    cur.execute(sql, (last, upto))
+                    columns = [d[0] for d in cur.description]
+                    schema = pa.schema([(c, arrow_type(c)) for c in columns])
+                    at, crawl = columns.index(time_column), columns.index(crawl_column)
+                    try:
+                        while True:
+                            rows, size = [], 0
+                            while len(rows) < chunk_rows and size < chunk_bytes:
+                                part = cur.fetchmany(min(1000, chunk_rows - len(rows)))
+                                if not part:
+                                    break
+                                rows.extend(part)
+                                size += sum(len(v) for row in part for v in row if isinstance(v, (str, bytes)))
+                            if not rows:
+                                break
+                            # Rows are ordered by crawl, so each day is one contiguous run
+                            for row_day, group in groupby(rows, key=lambda row: day_of(row[at])):
+                                group = list(group)
+                                if row_day != day:
+                                    if writer is not None:
+                                        writer.close()
+                                    day = row_day
+                                    directory = os.path.join(out_dir, name, f"date={day}")
+                                    os.makedirs(directory, exist_ok=True)
+                                    writer = pq.ParquetWriter(
+                                        os.path.join(directory, f"part-{group[0][crawl]}.parquet"), schema,
+                                        compression=compression
+                                    )
+                                values = list(zip(*group))
+                                writer.write_table(pa.Table.from_arrays(
+                                    [pa.array(values[i], type=schema.field(i).type) for i in range(len(columns))],
+                                    schema=schema
+                                ))
+                                total += len(group)
+                    finally:
+                        if writer is not None:
+                            writer.close()
+            logger.info(f"Export: {total} {name} row(s)")
+
+        stream("crawl", "SELECT id, begin, end FROM crawl WHERE id > %s AND id <= %s AND end IS NOT NULL ORDER BY id;",
+               "begin", "id")
+        stream("record", "SELECT r.*, c.begin AS crawl_begin FROM record_full r JOIN crawl c ON c.id = r.crawl_id "
+                         "WHERE r.crawl_id > %s AND r.crawl_id <= %s AND c.end IS NOT NULL ORDER BY r.crawl_id, r.ranking;",
+               "crawl_begin", "crawl_id")
+
+        os.makedirs(out_dir, exist_ok=True)
+        with open(state_path + ".tmp", "w", encoding="utf8") as f:
+            json.dump({"last_crawl_id": upto}, f)
+        os.replace(state_path + ".tmp", state_path)
+        logger.info(f"Export: crawls {last + 1}..{upto} written to {out_dir}")
 
+    @timed("get_board")
     def get_board(self) -> list:
         """
         TODO: Fetch current hot questions
@@ -270,11 +3051,10 @@ VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
         """
         
         results=[]
-        resp = requests.get("https://www.zhihu.com/hot",headers={"User-Agent":"Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:102.0) Gecko/20100101 Firefox/102.0","Cookie":"_zap=e40d7aab-28e0-4b4c-913f-890089f0dd7d; d_c0=\"APCfNZ0jMxWPTnqS2WvWHnRE2GLV1Il-PMs=|1656989140\"; Hm_lvt_98beee57fd2ef70ccdd5ca52b9740c49=1657110834,1657589610,1657780303,1657867448; captcha_session_v2=2|1:0|10:1657784325|18:captcha_session_v2|88:cFRRVzNMT1E5K3Z1RHdQVmR0TlBaSkRrZlJ0VXFBd0VkSGNQM2dtdDJXOEl4d0crQld4Rzl5Rkk5Qk9jQkVkZA==|9dc936750bdf67ddc8ca24dc6b3980df8782be9dd4d78eda52153435d0c6826a; __snaker__id=uGFy37d3vALoLEal; YD00517437729195%3AWM_NI=fK8WrIeSBevvj7MwDrfjWqM6Dud74NaQCrlNj7OPSRyYFf9zyOyKIXezuTg%2B4gGsxEQCsdREwCQ1YQmeR856xObMJkL1pKDhrskfZ11uVUlBl3kVXtyO%2FsAa9ydJu90nTVM%3D; YD00517437729195%3AWM_NIKE=9ca17ae2e6ffcda170e2e6ee97c85394ef8c9bf04796ac8ea7c55b968e9e86d55bf6ababd3c760aceda682e22af0fea7c3b92aa695f8b8f143a78d8e86f57eaae98398c77aa6b69992d03e88abacd8b746a38f8d93ef46aae981b1d25abb878a87bc72bb91b7accc54a7a6bbb5e621f8b98994fb4f939dbd85d14fb59d9fd2dc5bafbb9ed9b83ebc91aeaec96190efc0acc764b2ada587d93bf3ab9ab6ef4ab0eda5b7db80bb91e194c46bfba7acabf833f4b29cb7d037e2a3; YD00517437729195%3AWM_TID=Dv%2B9DP9yt5VEVQBAEUMvz7hOC78jbQ0X; gdxidpyhxdE=06W0aezaL%2BzWc9HqnacUyWy09%2BDqHb1fvGlaerUicy1T9qr9YwvEV%2BbMy8xZ7eJaBR43tm0oqL5M2nGHCiHTvDh8TzbsvTts%2B9N%2B0PD7oU47XpfP%2FY2MgeducEfN0x3Wuo2LcN1xuC0PGMycRp%2F21je6BnrD2O9HesYQhaInyG8ZmgQ8%3A1657799483632; _9755xjdesxxd_=32; captcha_ticket_v2=2|1:0|10:1657784400|17:captcha_ticket_v2|704:eyJ2YWxpZGF0ZSI6IkNOMzFfcUJ2QzRvRldydnp4STR0Mmh6bWFYMXhSNGJhaEgyYXRjLjdvX3k1Y2g1bTFnV0hnT0VwV2o4NXBnMlNsUHZGNERNbWFXU1hQbFFaNmYxZ3pKckdwc2lmazF6dnpYUldEZlZvRC5jbHF2dGE2eDF3SmQ2N2hzdmJfSWZHZDZIWUE1VEg3VlRLZ2h2SEhSbzE5bWNJcjBybzAuOWxxdTJMbl9UOHZvYUtKcEE1VW43UXpNNG1IWFpkMENYNjBEMElZZGpkRzYwV0NHclNnMmlyQ2ouNDFGTDhWU2F2ckZzWjB0Vl9iX2xhVl9HY2hLOTVENFFMQVEwMXp3cU5Cb083R1haaW9PMjZoMHpCb3JpeGs0NFNtYUtnVmhqVkVYbzFJWE13N2laY0FpanFrVXFwSnVDLURlODc3cm5aQklWb0FWTURId1o2b3lwZU1XNEt1X2VzYkkyVWJkMnhFYU0weF9MbUludEluZ3hTMmRhUy45OGlYWUlUZXJfTlpPUXBQdzJqYlpLRjJpeE91d3AwcXJTX2VjUm55bkZnLmR1N3QxSHVIOC1sbXV4dG5sbE9XWG00YVNDdVVSbHRqb0RnSjZnY2ZrSndfa2xWMUNXcjV2OHBuNjhHNUs4aVA4SGdRSG5aUC5JbG9lUGRUeWkxRGhXazBxdFJKY2djMyJ9|051c3cbb2faab6d0e119a9c14fc44c4f1aeda6b99f8c08b11936bea89184a2ff; z_c0=2|1:0|10:1657784412|4:z_c0|92:Mi4xd0lQV0JBQUFBQUFBOEo4MW5TTXpGU1lBQUFCZ0FsVk5XeGE5WXdBTXg1NV96Z2RwUzBPSklNMllWVXgzYU1uYVBR|c47d4baed05afe28ed0159c80293653eaf52ad96be4ba27958921fca5b9ebfa4; q_c1=238150b8f0c24666838561105122e78b|1657784412000|1657784412000; tst=h; _xsrf=cecc4a2d-fdff-487b-b811-6dac2205257f; KLBRSID=cdfcc1d45d024a211bb7144f66bda2cf|1657867710|1657867446; Hm_lpvt_98beee57fd2ef70ccdd5ca52b9740c49=1657867448; NOT_UNREGISTER_WAITING=1; SESSIONID=69Mx5U91LEmLpgtnBM0x2gjWwbbhIslmW0svzs03wQI; JOID=VFoSAUNwgT4SaYLXT3R74d4BLmpdQr12YFLT63sywFZbE-unJM2N4HRjg9dAHyQycwp9ItVyuRmPKRNUOWIzHEo=; osd=V18RCk5zhD0ZZIHSTH924tsCJWdeR759bVHW6HA_w1NYGOakIc6G7XdmgNxNHCExeAd-J9Z5tBqKKhhZOmcwF0c="})
-        soup = BS(resp.text,'lxml')
-        script=soup.find("script",id ='js-initialData',type="text/json")
-        script=json.loads(script.contents[0])
-        s2=script['initialState']['topstory']['hotList']
+        resp = self.http.get(self.settings["config"].get("base_url", "https://www.zhihu.com") + "/hot")
+        if resp.status_code != 200:
+            raise RuntimeError(resp)
+        s2=extract_initial_data(resp.content, ("initialState", "topstory", "hotList"))
         for i in range(len(s2)):
           s3=s2[i]['target']
           temp={}
@@ -292,6 +3072,7 @@ VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
 
         raise NotImplementedError
 
+    @timed("get_question")
     def get_question(self, qid: int) -> dict:
         """
         TODO: Fetch question info by question ID
@@ -331,21 +3112,21 @@ VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
           temp['raw']='skip'
           temp['hit_at']=0.0
           return temp
-        url = "https://www.zhihu.com/question/"+str(qid)
+        url = self.settings["config"].get("base_url", "https://www.zhihu.com") + "/question/"+str(qid)
         time1=time.time()
-        resp = requests.get(url,headers={"Cookie":"SESSIONID=NEgUlT0aMHRJE387Cw5T1jvOv54VxsO37dPBGflzynr; JOID=VFkWCkK6yM7tcFJrTLUwFSkd9dRa2f2qnk8TJyvWu7mzA24jNJCVFYB4V2NGdXwQXIzLtM50d930a7rEWYlbno4=; osd=UFgSA02-ycrkf1ZqSLw_ESgZ_Nte2PmjkUsSIyLZv7i3CmEnNZScGoR5U2pJcX0UVYPPtcp9eNn1b7PLXYhfl4E=; _zap=e40d7aab-28e0-4b4c-913f-890089f0dd7d; d_c0=\"APCfNZ0jMxWPTnqS2WvWHnRE2GLV1Il-PMs=|1656989140\"; Hm_lvt_98beee57fd2ef70ccdd5ca52b9740c49=1657110834,1657589610,1657780303,1657867448; captcha_session_v2=2|1:0|10:1657784325|18:captcha_session_v2|88:cFRRVzNMT1E5K3Z1RHdQVmR0TlBaSkRrZlJ0VXFBd0VkSGNQM2dtdDJXOEl4d0crQld4Rzl5Rkk5Qk9jQkVkZA==|9dc936750bdf67ddc8ca24dc6b3980df8782be9dd4d78eda52153435d0c6826a; __snaker__id=uGFy37d3vALoLEal; YD00517437729195%3AWM_NI=fK8WrIeSBevvj7MwDrfjWqM6Dud74NaQCrlNj7OPSRyYFf9zyOyKIXezuTg%2B4gGsxEQCsdREwCQ1YQmeR856xObMJkL1pKDhrskfZ11uVUlBl3kVXtyO%2FsAa9ydJu90nTVM%3D; YD00517437729195%3AWM_NIKE=9ca17ae2e6ffcda170e2e6ee97c85394ef8c9bf04796ac8ea7c55b968e9e86d55bf6ababd3c760aceda682e22af0fea7c3b92aa695f8b8f143a78d8e86f57eaae98398c77aa6b69992d03e88abacd8b746a38f8d93ef46aae981b1d25abb878a87bc72bb91b7accc54a7a6bbb5e621f8b98994fb4f939dbd85d14fb59d9fd2dc5bafbb9ed9b83ebc91aeaec96190efc0acc764b2ada587d93bf3ab9ab6ef4ab0eda5b7db80bb91e194c46bfba7acabf833f4b29cb7d037e2a3; YD00517437729195%3AWM_TID=Dv%2B9DP9yt5VEVQBAEUMvz7hOC78jbQ0X; gdxidpyhxdE=06W0aezaL%2BzWc9HqnacUyWy09%2BDqHb1fvGlaerUicy1T9qr9YwvEV%2BbMy8xZ7eJaBR43tm0oqL5M2nGHCiHTvDh8TzbsvTts%2B9N%2B0PD7oU47XpfP%2FY2MgeducEfN0x3Wuo2LcN1xuC0PGMycRp%2F21je6BnrD2O9HesYQhaInyG8ZmgQ8%3A1657799483632; _9755xjdesxxd_=32; captcha_ticket_v2=2|1:0|10:1657784400|17:captcha_ticket_v2|704:eyJ2YWxpZGF0ZSI6IkNOMzFfcUJ2QzRvRldydnp4STR0Mmh6bWFYMXhSNGJhaEgyYXRjLjdvX3k1Y2g1bTFnV0hnT0VwV2o4NXBnMlNsUHZGNERNbWFXU1hQbFFaNmYxZ3pKckdwc2lmazF6dnpYUldEZlZvRC5jbHF2dGE2eDF3SmQ2N2hzdmJfSWZHZDZIWUE1VEg3VlRLZ2h2SEhSbzE5bWNJcjBybzAuOWxxdTJMbl9UOHZvYUtKcEE1VW43UXpNNG1IWFpkMENYNjBEMElZZGpkRzYwV0NHclNnMmlyQ2ouNDFGTDhWU2F2ckZzWjB0Vl9iX2xhVl9HY2hLOTVENFFMQVEwMXp3cU5Cb083R1haaW9PMjZoMHpCb3JpeGs0NFNtYUtnVmhqVkVYbzFJWE13N2laY0FpanFrVXFwSnVDLURlODc3cm5aQklWb0FWTURId1o2b3lwZU1XNEt1X2VzYkkyVWJkMnhFYU0weF9MbUludEluZ3hTMmRhUy45OGlYWUlUZXJfTlpPUXBQdzJqYlpLRjJpeE91d3AwcXJTX2VjUm55bkZnLmR1N3QxSHVIOC1sbXV4dG5sbE9XWG00YVNDdVVSbHRqb0RnSjZnY2ZrSndfa2xWMUNXcjV2OHBuNjhHNUs4aVA4SGdRSG5aUC5JbG9lUGRUeWkxRGhXazBxdFJKY2djMyJ9|051c3cbb2faab6d0e119a9c14fc44c4f1aeda6b99f8c08b11936bea89184a2ff; z_c0=2|1:0|10:1657784412|4:z_c0|92:Mi4xd0lQV0JBQUFBQUFBOEo4MW5TTXpGU1lBQUFCZ0FsVk5XeGE5WXdBTXg1NV96Z2RwUzBPSklNMllWVXgzYU1uYVBR|c47d4baed05afe28ed0159c80293653eaf52ad96be4ba27958921fca5b9ebfa4; q_c1=238150b8f0c24666838561105122e78b|1657784412000|1657784412000; tst=h; _xsrf=cecc4a2d-fdff-487b-b811-6dac2205257f; KLBRSID=e42bab774ac0012482937540873c03cf|1657886298|1657884328; Hm_lpvt_98beee57fd2ef70ccdd5ca52b9740c49=1657885994; SESSIONID=d7ns0FNmctuTs3Oz0vTpLUEgueUTQn9oSo8KRFcBeOr; JOID=VFoSAUNwgT4SaYLXT3R74d4BLmpdQr12YFLT63sywFZbE-unJM2N4HRjg9dAHyQycwp9ItVyuRmPKRNUOWIzHEo=; osd=V18RCk5zhD0ZZIHSTH924tsCJWdeR759bVHW6HA_w1NYGOakIc6G7XdmgNxNHCExeAd-J9Z5tBqKKhhZOmcwF0c=;NOT_UNREGISTER_WAITING=1","User-Agent":"Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:102.0) Gecko/20100101 Firefox/102.0"})
-        soup=BS(resp.text,'lxml')
-        ans=soup.find('script',id="js-initialData",type='text/json')
-        content=json.loads(ans.text)
-        content_i=content['initialState']['entities']['questions'][str(qid)]
+        resp = self.http.get(url)
+        if resp.status_code != 200:
+            raise RuntimeError(resp)
+        content_i=extract_initial_data(resp.content, ("initialState", "entities", "questions", str(qid)))
         temp={}
-        temp['created']=content['initialState']['entities']['questions'][str(qid)]['created']
+        temp['created']=content_i['created']
         temp['followerCount']=content_i['followerCount']
         temp["visitCount"]=content_i['visitCount']
         temp['answerCount']=content_i['answerCount']
         temp['title']=content_i['title']
         temp['raw']=content_i['detail']
         temp['hit_at']=time1
+        temp['bytes']=resp.timing['bytes']
         # Hint: - Parse JSON, which is embedded in a <script> and contains all information you need.
         #       - After find the element in soup, use `.text` attribute to get the inner text
         #       - Use `json.loads` to convert JSON string to `dict` or `list`
@@ -356,5 +3137,40 @@ VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
         raise NotImplementedError
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Zhihu hot list tracker")
+    parser.add_argument("command", nargs="?", default="watch", choices=["watch", "import", "rollup", "export", "coordinator", "worker", "reindex", "search"])
+    parser.add_argument("path", nargs="?", help="dump file for `import`, output directory for `export`, query for `search`")
+    parser.add_argument("--database", help="database for `import`, which must not be the crawler's")
+    args = parser.parse_args()
     z = ZhihuCrawler()
-    z.watch()
+    if args.command not in ("watch", "reindex", "search") and not isinstance(z.storage, MySQLStorage):
+        parser.error(f"{args.command} needs the MySQL storage")
+    if args.command == "import":
+        if args.path is None:
+            parser.error("import needs the path of a dump file")
+        if args.database is None or args.database == z.settings["mysql"].get("database"):
+            parser.error("import needs --database other than the crawler's, as a dump drops its tables")
+        z.import_dump(args.path, args.database)
+    elif args.command == "export":
+        if args.path is None:
+            parser.error("export needs an output directory")
+        z.export(args.path)
+    elif args.command == "rollup":
+        z.create_table()
+        z.rebuild_rollups()
+    elif args.command == "coordinator":
+        z.coordinate()
+    elif args.command == "worker":
+        z.work()
+    elif args.command == "reindex":
+        z.create_table()
+        z.reindex()
+    elif args.command == "search":
+        if args.path is None:
+            parser.error("search needs a query")
+        z.create_table()
+        z.warm_index()
+        for qid, title in z.search(args.path):
+            print(qid, title)
+    else:
+        z.watch()